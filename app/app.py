@@ -1,8 +1,8 @@
-from fastapi import FastAPI, Query, HTTPException, Request
-from fastapi.responses import RedirectResponse, HTMLResponse
+from fastapi import FastAPI, Query, Header, HTTPException, Request
+from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel, NonNegativeInt, PositiveInt, HttpUrl, root_validator, Field
-from typing import Union, List, Optional, Literal
+from pydantic import BaseModel, NonNegativeInt, PositiveInt, HttpUrl, root_validator, Field, ConfigDict, ValidationError
+from typing import Union, List, Optional, Literal, Any
 from markdownify import markdownify as md
 import os
 import time
@@ -11,11 +11,31 @@ import sys
 import httpx
 import asyncio
 import ast
+import re
 import random
+import socket
+import ipaddress
 import yaml
 import csv
-from datetime import datetime
-from jinja2 import Template, Environment, BaseLoader
+import copy
+import functools
+import hashlib
+import sqlite3
+import threading
+import uuid
+import contextvars
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urljoin
+from bs4 import BeautifulSoup
+from collections import OrderedDict, ChainMap, deque
+from collections.abc import Mapping
+from types import MappingProxyType
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from contextlib import asynccontextmanager
+from jinja2 import Template, Environment, BaseLoader, meta
 from dotenv import load_dotenv
 
 load_dotenv()  # take environment variables from .env.
@@ -30,6 +50,15 @@ FIRECRAWL_EXTRACT_ENDPOINT_DEFAULT = "https://api.firecrawl.dev/v1/extract"
 
 #CRAWL4AI_TIMEOUT = (int)(os.getenv("CRAWL4AI_TIMEOUT", 30))
 HTTP_TIMEOUT = (int)(os.getenv("HTTP_TIMEOUT", 30))
+MAX_RESPONSE_SIZE = (int)(os.getenv("MAX_RESPONSE_SIZE", 50 * 1024 * 1024)) # bytes read from a backend answer, 0 for no limit
+
+# connection pool defaults, can be overridden per backend in the `client` section of the yml files
+HTTP_MAX_CONNECTIONS = (int)(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = (int)(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = (float)(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP2 = os.getenv("HTTP2", "true")
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None # HTTP/2 support of httpx, installed with httpx[http2]
 
 SEARCH_BACKEND = os.getenv("SEARCH_BACKEND")
 SCRAPE_BACKEND = os.getenv("SCRAPE_BACKEND")
@@ -39,10 +68,95 @@ SCRAPE_BACKEND_ROTATE = os.getenv("SCRAPE_BACKEND_ROTATE")
 
 SEARCH_RESULT_NUMBER_DEFAULT = 5
 
+# typed: "{{ path }}" returns the object itself and types are declared in the yml (_type: int, ...)
+# literal_eval: every rendered string is parsed as a Python literal, as in previous versions
+RENDER_MODE = os.getenv("RENDER_MODE", "typed")
+
 LOG_FILE = os.getenv("LOG_FILE")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "csv") # csv or jsonl
+LOG_QUEUE_SIZE = (int)(os.getenv("LOG_QUEUE_SIZE", 10000)) # records waiting to be written, the next ones are dropped
+LOG_FLUSH_INTERVAL = (float)(os.getenv("LOG_FLUSH_INTERVAL", 1)) # seconds between two writes to the log file
+LOG_FLUSH_SIZE = (int)(os.getenv("LOG_FLUSH_SIZE", 500)) # records written at once
+LOG_MAX_SIZE = (int)(os.getenv("LOG_MAX_SIZE", 10 * 1024 * 1024)) # bytes before the log file is rotated, 0 to disable
+LOG_ROTATE_INTERVAL = (float)(os.getenv("LOG_ROTATE_INTERVAL", 0)) # seconds before the log file is rotated, 0 to disable
+LOG_BACKUP_COUNT = (int)(os.getenv("LOG_BACKUP_COUNT", 5)) # rotated files kept (LOG_FILE.1, LOG_FILE.2...)
+
+FANOUT_CONCURRENCY = (int)(os.getenv("FANOUT_CONCURRENCY", 10)) # concurrent scrapes per backend in a fan-out batch
+FANOUT_HOST_CONCURRENCY = (int)(os.getenv("FANOUT_HOST_CONCURRENCY", 2)) # concurrent scrapes per host
+
+POLITENESS_DELAY = (float)(os.getenv("POLITENESS_DELAY", 0)) # min seconds between two scrapes of the same host
+RESPECT_ROBOTS = os.getenv("RESPECT_ROBOTS", "false") # wait the Crawl-delay of robots.txt between two scrapes of a host
+ROBOTS_TTL = (float)(os.getenv("ROBOTS_TTL", 3600)) # seconds a robots.txt is cached
+ROBOTS_CACHE_SIZE = (int)(os.getenv("ROBOTS_CACHE_SIZE", 10000)) # hosts whose crawl delay is cached, the least recently used are dropped
+
+FAILOVER = os.getenv("FAILOVER", "true") # on error, try the next backend of the comma-separated list
+FAILOVER_STATUS = [401, 402, 403, 408, 429, 500, 502, 503, 504] # default retryable status codes
+
+SCRAPE_HEDGE = os.getenv("SCRAPE_HEDGE", "false") # send slow scrapes to a second backend
+SCRAPE_HEDGE_PERCENTILE = (float)(os.getenv("SCRAPE_HEDGE_PERCENTILE", 95)) # latency percentile of the backend after which the scrape is hedged
+SCRAPE_HEDGE_DELAY = (float)(os.getenv("SCRAPE_HEDGE_DELAY", 5)) # seconds, used until the backend has enough latency samples
+BACKEND_STATS_WINDOW = (int)(os.getenv("BACKEND_STATS_WINDOW", 100)) # number of latencies kept per backend
+BACKEND_EWMA_ALPHA = (float)(os.getenv("BACKEND_EWMA_ALPHA", 0.3)) # weight of the last request in the moving averages
+CIRCUIT_BREAKER_THRESHOLD = (int)(os.getenv("CIRCUIT_BREAKER_THRESHOLD", 5)) # consecutive failures before a backend is ejected
+CIRCUIT_BREAKER_COOLDOWN = (float)(os.getenv("CIRCUIT_BREAKER_COOLDOWN", 30)) # seconds before an ejected backend is tried again
+RATE_LIMIT_MAX_WAIT = (float)(os.getenv("RATE_LIMIT_MAX_WAIT", 30)) # seconds a request waits for a rate limited backend before a 429
+
+CACHE_TTL = (float)(os.getenv("CACHE_TTL", 0)) # seconds, 0 disables the cache unless a backend sets its own ttl
+CACHE_MAX_SIZE = (int)(os.getenv("CACHE_MAX_SIZE", 64 * 1024 * 1024)) # bytes kept in memory
+CACHE_FILE = os.getenv("CACHE_FILE") # optional SQLite file for the on-disk tier
+
+BATCH_SCRAPE_ASYNC = os.getenv("BATCH_SCRAPE_ASYNC", "false") # batch scrape returns a job id, as Firecrawl
+JOB_FILE = os.getenv("JOB_FILE", "jobs.db") # SQLite file of the batch scrape jobs
+JOB_WORKERS = (int)(os.getenv("JOB_WORKERS", 4)) # batch scrape jobs run at the same time
+JOB_TTL = (float)(os.getenv("JOB_TTL", 24 * 3600)) # seconds the results of a job are kept
+JOB_PAGE_SIZE = (int)(os.getenv("JOB_PAGE_SIZE", 100)) # documents per page of the job status
+JOB_LEASE = (float)(os.getenv("JOB_LEASE", 60)) # seconds without heartbeat before a job of a dead worker is taken over
+JOB_TIMEOUT = (float)(os.getenv("JOB_TIMEOUT", 3600)) # seconds a background job polls a batch backend before it fails
+
+CONTENT_FILE = os.getenv("CONTENT_FILE", "content.db") # SQLite file of the last version of the pages scraped with changeTracking
+CONTENT_TTL = (float)(os.getenv("CONTENT_TTL", 30 * 24 * 3600)) # seconds a page version is kept
+
+STATE_STORE = os.getenv("STATE_STORE", "memory") # memory, sqlite:///path/state.db or redis://host:6379/0, shared by the workers
+WORKERS = (int)(os.getenv("WORKERS", 1)) # worker processes started by `python app.py`
+PORT = (int)(os.getenv("PORT", 8000))
+RELOAD = os.getenv("RELOAD", "false") # reload on code changes, development only (single worker)
+
+DIRECT_PROCESSES = (int)(os.getenv("DIRECT_PROCESSES", min(4, os.cpu_count() or 1))) # processes converting HTML for the direct backend, 0 for a thread
+DIRECT_USER_AGENT = os.getenv("DIRECT_USER_AGENT", "Mozilla/5.0 (compatible; CrawlRouter)")
+DIRECT_ALLOW_PRIVATE = os.getenv("DIRECT_ALLOW_PRIVATE", "false") # let the direct backend fetch private, loopback and link-local addresses
+DIRECT_MAX_REDIRECTS = (int)(os.getenv("DIRECT_MAX_REDIRECTS", 10)) # redirects followed by the direct backend
+
+CONFIG_RELOAD_INTERVAL = (float)(os.getenv("CONFIG_RELOAD_INTERVAL", 5)) # seconds between two checks of the backend yml files, 0 to disable
+
+TEMPLATE_ENV = os.getenv("TEMPLATE_ENV", "") # comma-separated environment variables given to the templates, besides the ones they use
+
+TRUE_VALUES = ['true', '1', 'y', 'yes']
+
+http_clients = {} # pooled clients, one per (type, backend), closed with the app
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_http_client() # default client for the Firecrawl bridge endpoints
+    request_logger.start()
+    await job_queue.start()
+    await asyncio.to_thread(content_store.clean)
+    config_watcher = asyncio.create_task(watch_configs()) if CONFIG_RELOAD_INTERVAL > 0 else None
+    yield
+    if config_watcher:
+        config_watcher.cancel()
+    await job_queue.stop()
+    await request_logger.stop()
+    for client in [*http_clients.values(), *retired_clients]:
+        await client.aclose()
+    http_clients.clear()
+    retired_clients.clear()
+    await response_cache.close()
+    await state_store.close()
+    content_store.close()
+    if direct_pool is not None:
+        direct_pool.shutdown(cancel_futures=True)
 
-last_search_backend = None # to rotate search engine
-last_scrape_backend = None # to rotate scrape engine
 
 app = FastAPI(    title="CrawlRouter",
    # description=description,
@@ -55,11 +169,139 @@ app = FastAPI(    title="CrawlRouter",
     license_info={
         "name": "GNU Affero General Public License v3.0",
         "url": "https://www.gnu.org/licenses/agpl-3.0.en.html",
-    },)
+    },
+    lifespan=lifespan,)
 
 templates = Jinja2Templates(directory="templates")
 
 
+######## Metrics
+
+class Metric:
+    """Counter, gauge or histogram with labels, exposed in the Prometheus text format"""
+
+    def __init__(self, name: str, kind: str, help: str, buckets: tuple = None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.buckets = buckets
+        self.values = {} # labels -> value, or [count per bucket..., sum, count] for histograms
+
+    def inc(self, labels: tuple, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def observe(self, labels: tuple, value: float):
+        histogram = self.values.setdefault(labels, [0] * (len(self.buckets) + 2))
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def render(self, label_names: tuple) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.values.items():
+            pairs = [f'{name}="{escape_label(label)}"' for name, label in zip(label_names, labels)]
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{{{','.join(pairs)}}} {value}")
+                continue
+            for bucket, count in zip(self.buckets + ("+Inf",), value[:-2] + [value[-1]]):
+                bucket_pairs = ','.join(pairs + [f'le="{bucket}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_pairs}}} {count}")
+            lines.append(f"{self.name}_sum{{{','.join(pairs)}}} {value[-2]}")
+            lines.append(f"{self.name}_count{{{','.join(pairs)}}} {value[-1]}")
+        return lines
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RENDER_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+SIZE_BUCKETS = (1000, 10000, 100000, 1000000, 10000000)
+
+# labels: type (scrape, search, batch, extract, deep-research) and backend
+metrics = {
+    "requests": Metric("crawlrouter_requests_total", "counter", "Requests received"),
+    "errors": Metric("crawlrouter_errors_total", "counter", "Requests answered with an error, by status"),
+    "request_seconds": Metric("crawlrouter_request_seconds", "histogram", "Total time to answer a request", LATENCY_BUCKETS),
+    "response_bytes": Metric("crawlrouter_response_bytes", "histogram", "Size of the responses", SIZE_BUCKETS),
+    "in_flight": Metric("crawlrouter_requests_in_flight", "gauge", "Requests being answered"),
+    "upstream_seconds": Metric("crawlrouter_upstream_seconds", "histogram", "Time of the calls to the backends", LATENCY_BUCKETS),
+    "upstream_errors": Metric("crawlrouter_upstream_errors_total", "counter", "Failed calls to the backends, by status"),
+    "upstream_in_flight": Metric("crawlrouter_upstream_in_flight", "gauge", "Calls to the backends in flight"),
+    "render_seconds": Metric("crawlrouter_render_seconds", "histogram", "Time to render the request and response templates", RENDER_BUCKETS),
+}
+METRIC_LABELS = {"errors": ("type", "backend", "status"), "upstream_errors": ("type", "backend", "status"), "in_flight": ("type",)}
+
+ENDPOINT_TYPES = [ # path prefix -> type
+    ("/v1/scrape", "scrape"),
+    ("/scrape", "scrape"),
+    ("/v1/search", "search"),
+    ("/v1/batch/scrape", "batch"),
+    ("/v1/extract", "extract"),
+    ("/v1/deep-research", "deep-research"),
+]
+
+request_labels = contextvars.ContextVar("request_labels", default=None) # backend chosen for the current request
+
+
+def metric_type(type: str) -> str:
+    return "batch" if type == "batch_scrape" else type
+
+
+def set_request_backend(backend: str):
+    """Label the current request with its backend, the first backend set wins (search + scrape)"""
+    labels = request_labels.get()
+    if labels is not None:
+        labels.setdefault('backend', backend)
+
+
+class MetricsMiddleware:
+    """Count the requests of the API endpoints, their status, duration and response size"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        type = None
+        if scope['type'] == 'http':
+            type = next((type for prefix, type in ENDPOINT_TYPES if scope['path'] == prefix or scope['path'].startswith(prefix + '/')), None)
+        if type is None:
+            return await self.app(scope, receive, send)
+
+        labels = {}
+        token = request_labels.set(labels)
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_and_measure(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        metrics["in_flight"].inc((type,))
+        try:
+            await self.app(scope, receive, send_and_measure)
+        finally:
+            metrics["in_flight"].inc((type,), -1)
+            request_labels.reset(token)
+            backend = labels.get('backend', 'none')
+            metrics["requests"].inc((type, backend))
+            metrics["request_seconds"].observe((type, backend), time.perf_counter() - start)
+            metrics["response_bytes"].observe((type, backend), size)
+            if status >= 400:
+                metrics["errors"].inc((type, backend, status))
+
+
+app.add_middleware(MetricsMiddleware)
+
+
 # Initialize Jinja2 Environment
 env = Environment(
    loader=BaseLoader(), # Or set the path where your config are
@@ -70,12 +312,14 @@ env = Environment(
 
 def generic_resolver(data: dict, path: str):
     """Resolve dot-notated paths in nested data"""
+    if not path:
+        return data
     keys = path.split('.')
     for key in keys:
         if isinstance(data, list) and key.isdigit():
             data = data[int(key)] if int(key) < len(data) else None
         else:
-            data = data.get(key, None) if isinstance(data, dict) else None
+            data = data.get(key, None) if isinstance(data, Mapping) else None
         if data is None:
             return None
     return data
@@ -109,23 +353,152 @@ def delete_empty_keys(data):
     else:
         return data
     
+SIMPLE_EXPRESSION = re.compile(r"^\{\{\s*([A-Za-z_]\w*(?:\.\w+)*)\s*\}\}$") # "{{ data.results.0 }}"
+
+
+def resolve_expression(data, keys: list):
+    """Resolve a simple expression to the object itself, without rendering it to a string"""
+    for key in keys:
+        if isinstance(data, Mapping):
+            if key not in data:
+                return '' # what Jinja renders for undefined values
+            data = data[key]
+        elif isinstance(data, list) and key.isdigit():
+            if int(key) >= len(data):
+                return ''
+            data = data[int(key)]
+        else:
+            data = getattr(data, key, '')
+    return data
+
+
+class CompiledTemplate:
+    """String leaf of a backend config, compiled once when the config is loaded"""
+    __slots__ = ('source', 'template', 'path', 'value', 'error', 'names')
+
+    def __init__(self, source: str):
+        self.source = source
+        self.template = None
+        self.path = None
+        self.error = None
+        self.names = frozenset() # variables read from the context
+        try:
+            template = env.from_string(source)
+            match = SIMPLE_EXPRESSION.match(source)
+            if RENDER_MODE == "typed" and match:
+                self.path = match.group(1).split('.')
+                self.names = frozenset(self.path[:1])
+            elif '{{' in source or '{%' in source or '{#' in source:
+                self.template = template
+                self.names = frozenset(meta.find_undeclared_variables(env.parse(source)))
+            else: # plain literal, rendered once and never goes through Jinja again
+                self.value = self.convert(template.render())
+        except Exception as e:
+            self.error = str(e)
+            self.value = f"Template Error: {str(e)}"
+
+    @staticmethod
+    def convert(rendered: str):
+        return literal_eval(rendered) if RENDER_MODE == "literal_eval" else rendered
+
+    def render(self, context: dict):
+        if self.path is not None:
+            return resolve_expression(context, self.path)
+        if self.template is None:
+            # literals can be lists or dicts, don't share them between requests
+            return copy.deepcopy(self.value) if isinstance(self.value, (list, dict)) else self.value
+        try:
+            return self.convert(self.template.render(**context))
+        except Exception as e:
+            return f"Template Error: {str(e)}"
+
+
+def literal_eval(rendered: str):
+    """Try parsing as Python literal (e.g., int, dict, list)"""
+    try:
+        return ast.literal_eval(rendered)
+    except (SyntaxError, ValueError):
+        return rendered
+
+
+def coerce(value, type: str):
+    """Convert a rendered value to the type declared with `_type`"""
+    try:
+        if type == 'str':
+            return '' if value is None else str(value)
+        if value is None or value == '':
+            return None
+        if type == 'int':
+            return int(value)
+        if type == 'float':
+            return float(value)
+        if type == 'bool':
+            return value.lower() in TRUE_VALUES if isinstance(value, str) else bool(value)
+        if type == 'json':
+            return json.loads(value) if isinstance(value, str) else value
+        if type == 'literal':
+            return literal_eval(value) if isinstance(value, str) else value
+    except (TypeError, ValueError):
+        pass
+    return value
+
+COERCE_TYPES = ['str', 'int', 'float', 'bool', 'json', 'literal']
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(source: str) -> CompiledTemplate:
+    return CompiledTemplate(source)
+
+
+class Directive:
+    """`_type` node of a response config (array, object or type coercion), compiled once"""
+    __slots__ = ('type', 'path', 'fields', 'value')
+
+    def __init__(self, config: dict):
+        self.type = config['_type']
+        self.path = config.get('_path', '')
+        self.fields = compile_config(config.get('fields'))
+        self.value = compile_config(config.get('value'))
+
+    def __eq__(self, other):
+        return isinstance(other, Directive) and all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+
+def compile_config(config):
+    """Recursively compile the string leaves and the `_type` directives of a config, other directives are kept as is"""
+    if isinstance(config, dict) and '_type' in config:
+        return Directive(config)
+    if isinstance(config, dict):
+        return {
+            key: value if key.startswith('_') else compile_config(value)
+            for key, value in config.items()
+        }
+    elif isinstance(config, list):
+        return [compile_config(item) for item in config]
+    elif isinstance(config, str):
+        return compile_template(config)
+    return config
+
+
 async def render_config(response_config: dict, response: dict):
     """Recursively process configuration nodes"""
-    if isinstance(response_config, dict):
-        # Handle special directives
-        if '_type' in response_config:
-            if response_config['_type'] == 'array':
-                source_data = generic_resolver(response, response_config.get('_path', '')) or []
-                return [
-                    await render_config(response_config['fields'], {'item': item})
-                        for item in source_data
-                ]
-            
-            if response_config['_type'] == 'object': # does not work
-                source_data = generic_resolver(response, response_config.get('_path', '')) or {}
-                return await render_config(
-                    response_config['fields'], source_data)
+    if isinstance(response_config, Directive):
+        if response_config.type == 'array':
+            source_data = generic_resolver(response, response_config.path) or []
+            return [
+                await render_config(response_config.fields, {'item': item})
+                    for item in source_data
+            ]
+
+        if response_config.type == 'object':
+            # the fields see the object as `item`, as in arrays, and its keys directly
+            source_data = generic_resolver(response, response_config.path) or {}
+            layer = {**(source_data if isinstance(source_data, dict) else {}), 'item': source_data}
+            return await render_config(response_config.fields, render_context(layer, response))
+
+        return coerce(await render_config(response_config.value, response), response_config.type)
 
+    if isinstance(response_config, dict):
         return {
             key: await render_config(value, response)
             for key, value in response_config.items()
@@ -136,26 +509,53 @@ async def render_config(response_config: dict, response: dict):
         return [await render_config(item, response) 
                 for item in response_config]
     
+    elif isinstance(response_config, CompiledTemplate):
+        return response_config.render(response)
+
     elif isinstance(response_config, str):
         # Render Jinja2 templates
-        try:
-            rendered = env.from_string(response_config).render(**response)
-            # Try parsing as Python literal (e.g., int, dict, list)
-            if isinstance(rendered, str):
-                try:
-                    rendered = ast.literal_eval(rendered)
-                except (SyntaxError, ValueError):
-                    pass
-            # if rendered == None:
-            #     rendered = ''
-            return rendered
-        except Exception as e:
-            return f"Template Error: {str(e)}"
+        return compile_template(response_config).render(response)
     
     return response_config
 
-    
-async def make_api_call(config: dict):
+
+async def timed_render_config(type: str, backend: str, config, context: dict):
+    """render_config, with its duration in the metrics"""
+    start = time.perf_counter()
+    try:
+        return await render_config(config, context)
+    finally:
+        metrics["render_seconds"].observe((metric_type(type), backend), time.perf_counter() - start)
+
+
+def build_http_client(client_config: dict = None) -> httpx.AsyncClient:
+    """Create a pooled client from the `client` section of a backend"""
+    client_config = client_config or {}
+    limits = httpx.Limits(
+        max_connections=int(client_config.get('max_connections', HTTP_MAX_CONNECTIONS)),
+        max_keepalive_connections=int(client_config.get('max_keepalive_connections', HTTP_MAX_KEEPALIVE_CONNECTIONS)),
+        keepalive_expiry=float(client_config.get('keepalive_expiry', HTTP_KEEPALIVE_EXPIRY)),
+    )
+    http2 = str(client_config.get('http2', HTTP2)).lower() in TRUE_VALUES and HTTP2_AVAILABLE
+    return httpx.AsyncClient(limits=limits, http2=http2, timeout=HTTP_TIMEOUT)
+
+
+def get_backends(type: str) -> dict:
+    return {"search": search_backends, "scrape": scrape_backends, "batch_scrape": batch_scrape_backends}.get(type, {})
+
+
+def get_http_client(type: str = None, backend: str = None) -> httpx.AsyncClient:
+    """Return the pooled client of a backend, created on first use"""
+    key = (type, backend)
+    client = http_clients.get(key)
+    if client is None or client.is_closed:
+        client = build_http_client(get_backends(type).get(backend, {}).get('client'))
+        http_clients[key] = client
+    return client
+
+
+async def make_api_call(config: dict, client: httpx.AsyncClient = None, info: dict = None):
+        """Call the backend, info (optional) receives the size of its answer"""
         method = config.get('method', 'GET').upper()
         url = config.get('url')
         if not url:
@@ -177,42 +577,152 @@ async def make_api_call(config: dict):
         #print(url)
         #print(request_args)
       
-        async with httpx.AsyncClient() as client:
-            try:
-                #request = httpx.Request(**request_args)
-                #response = await client.send(request)
-                if method == "POST":
-                    response = await client.post(url, **request_args)
-                else:
-                    response = await client.get(url, **request_args)
+        client = client or get_http_client()
+        try:
+            # streamed, so a huge answer is stopped at MAX_RESPONSE_SIZE instead of being loaded in memory
+            async with client.stream(method, url, **request_args) as response:
                 response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-                try:
-                    return response.json()
-                except:
-                    return {'text': response.text}
-            except httpx.HTTPStatusError as e:
-                raise HTTPException(status_code=e.response.status_code, detail=str(e))
-            except httpx.RequestError as e:
-                raise HTTPException(status_code=500, detail=f"Request error: {str(e)}")
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+                body = await read_body(response)
+            if info is not None:
+                info['size'] = len(body)
+            return parse_body(body, response.encoding)
+        except HTTPException:
+            raise
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=e.response.status_code, detail=str(e))
+        except httpx.TimeoutException as e:
+            raise HTTPException(status_code=504, detail=f"Timeout: {str(e)}")
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=500, detail=f"Request error: {str(e)}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
         
 
-def log_request(type, url_or_query, backend, endpoint, size, execution_time):
-    if LOG_FILE:
+async def read_body(response: httpx.Response, max_size: int = MAX_RESPONSE_SIZE) -> bytearray:
+    """Read a streamed answer, 502 as soon as it is bigger than max_size"""
+    length = response.headers.get('Content-Length', '')
+    if max_size and length.isdigit() and int(length) > max_size:
+        raise HTTPException(status_code=502, detail=f"Backend answer too large: {length} bytes, the limit is {max_size}")
+    body = bytearray()
+    async for chunk in response.aiter_bytes():
+        body += chunk
+        if max_size and len(body) > max_size:
+            raise HTTPException(status_code=502, detail=f"Backend answer too large: more than {max_size} bytes")
+    return body
+
+
+def parse_body(body: bytearray, encoding: str = None):
+    """JSON parsed from the bytes, without decoding them to a string first. {'text': ...} if it is not JSON"""
+    try:
+        return json.loads(body)
+    except ValueError:
+        return {'text': body.decode(encoding or 'utf-8', errors='replace')}
+
+
+class RequestLogger:
+    """Write the request logs from a background task: records are queued by the handlers
+    and written by batches in a thread, so logging never blocks the event loop"""
+
+    CSV_HEADER = ['Date/Time', 'Type', 'URL/Query', 'Backend', 'Endpoint', 'Size', 'API execution_time']
+
+    def __init__(self, path: str, format: str = "csv"):
+        self.path = path
+        self.format = format
+        self.queue = None
+        self.task = None
+        self.dropped = 0
+        self.opened_at = None # creation time of the current log file, for the time based rotation
+
+    def start(self):
+        if self.path and self.task is None:
+            self.queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Write the queued records and stop the writer"""
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+        self.queue = None
+
+    def log(self, record: dict):
+        if self.queue is None:
+            return
         try:
-            with open(LOG_FILE, 'a', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                if csvfile.tell() == 0: # Write header if file is empty
-                    writer.writerow(['Date/Time', 'Type', 'URL/Query', 'Backend', 'Endpoint', 'Size', 'API execution_time'])
-                if isinstance(url_or_query, str):
-                    writer.writerow([datetime.now(), type, url_or_query, backend, endpoint, size, round(execution_time, 3)])
-                else:
-                    for item in url_or_query:
-                        writer.writerow([datetime.now(), type, item, backend, endpoint, size, round(execution_time, 3)])
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run(self):
+        stopping = False
+        while not stopping:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < LOG_FLUSH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0, deadline - time.monotonic())))
+                except asyncio.TimeoutError:
+                    break
+            if batch[-1] is None: # sent by stop()
+                stopping = True
+                batch.pop()
+            if batch:
+                await asyncio.to_thread(self.write, batch)
+
+    def write(self, batch: list):
+        try:
+            self.rotate()
+            with open(self.path, 'a', newline='') as logfile:
+                if self.format == "jsonl":
+                    logfile.writelines(json.dumps(record, default=str) + "\n" for record in batch)
+                    return
+                writer = csv.writer(logfile)
+                if logfile.tell() == 0: # Write header if file is empty
+                    writer.writerow(self.CSV_HEADER)
+                for record in batch:
+                    url_or_query = record['url_or_query']
+                    for item in ([url_or_query] if isinstance(url_or_query, str) else url_or_query): # one row per url of a batch
+                        writer.writerow([record['date'], record['type'], item, record['backend'], record['endpoint'], record['size'], record['execution_time']])
         except Exception as e:
             print (f"Error during logging: {e}")
 
+    def rotate(self):
+        """Rename LOG_FILE to LOG_FILE.1 (and LOG_FILE.1 to LOG_FILE.2...) when it is too big or too old"""
+        if not os.path.exists(self.path):
+            self.opened_at = time.time()
+            return
+        if self.opened_at is None:
+            self.opened_at = os.path.getmtime(self.path)
+        too_big = LOG_MAX_SIZE and os.path.getsize(self.path) >= LOG_MAX_SIZE
+        too_old = LOG_ROTATE_INTERVAL and time.time() - self.opened_at >= LOG_ROTATE_INTERVAL
+        if not (too_big or too_old):
+            return
+        if LOG_BACKUP_COUNT > 0:
+            for index in range(LOG_BACKUP_COUNT - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{index}"):
+                    os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.opened_at = time.time()
+
+
+request_logger = RequestLogger(LOG_FILE, LOG_FORMAT)
+
+
+def log_request(type, url_or_query, backend, endpoint, size, execution_time):
+    request_logger.log({
+        'date': datetime.now().isoformat(sep=' '),
+        'type': type,
+        'url_or_query': url_or_query,
+        'backend': backend,
+        'endpoint': endpoint,
+        'size': size,
+        'execution_time': round(execution_time, 3),
+    })
+
 @app.get("/")
 async def read_home_ui(request: Request):
     return templates.TemplateResponse("home.html", {"request": request})
@@ -253,31 +763,20 @@ def get_endpoint(query_endpoint: Optional[str], env_key: str, default_endpoint=
     else:
         return default_endpoint
 
-async def make_request(url: str, headers: dict = None, params: dict = None, method: str = "GET"):
-    async with httpx.AsyncClient() as client:
-        try:
-            if method == "POST":
-                response = await client.post(url, headers=headers, json=params, timeout=HTTP_TIMEOUT)
-            else:
-                response = await client.get(url, headers=headers, params=params, timeout=HTTP_TIMEOUT)
-            response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=str(e))
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Request error: {str(e)}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
-
-
 def combined_search_scrape(search_result, scrapped_data):
     # Create a dictionary from the scrapped array for quick lookup
-    scrapped_dict = {item['metadata']['url']: item['markdown'] for item in scrapped_data}
+    scrapped_dict = {}
+    for item in scrapped_data:
+        metadata = item.get('metadata') or {}
+        if 'markdown' in item:
+            for key in ('sourceURL', 'url'):
+                if metadata.get(key):
+                    scrapped_dict[metadata[key].rstrip('/')] = item['markdown']
 
     # Combine the data
     combined_data = []
     for item in search_result['data']:
-        url = item['url']
+        url = item['url'].rstrip('/')
         if url in scrapped_dict:
             # Merge the data if the URL exists in both arrays
             combined_item = item.copy()
@@ -292,7 +791,26 @@ def combined_search_scrape(search_result, scrapped_data):
 
 class FirecrawlScapeModel(BaseModel):
     url: HttpUrl
-    formats: list[Literal["markdown", "html", "rawHtml", "links", "screenshot", "screenshot@fullPage", "json"]] = ["markdown"]
+    formats: list[Literal["markdown", "html", "rawHtml", "links", "screenshot", "screenshot@fullPage", "json", "changeTracking"]] = ["markdown"]
+    onlyMainContent: bool = True
+    includeTags: list[str] = None
+    excludeTags: list[str] = None
+    headers: dict = None
+    waitFor: NonNegativeInt = 0
+    mobile: bool = False
+    skipTlsVerification: bool = False
+    timeout: NonNegativeInt = 30000
+    jsonOptions: dict = None
+    actions: list[dict] = None
+    location: dict = None # {"country": "US", "languages":"en-US"}
+    removeBase64Images: bool = False
+    blockAds: bool = True
+    proxy: Literal["basic", "stealth"] = None
+
+
+class BatchScrapeQuery(BaseModel):
+    urls: list[HttpUrl]
+    formats: list[Literal["markdown", "html", "rawHtml", "links", "screenshot", "screenshot@fullPage", "json", "changeTracking"]] = ["markdown"]
     onlyMainContent: bool = True
     includeTags: list[str] = None
     excludeTags: list[str] = None
@@ -314,8 +832,13 @@ class FirecrawlScapeModel(BaseModel):
 async def scrape_post(
     body: FirecrawlScapeModel,
     backend: Optional[str] = Query(None, description="Backend to use (optional)"),
+    cache_control: Optional[str] = Header(None, description="no-cache to bypass the cache, no-store to not cache the response"),
+    hedge: Optional[bool] = Query(None, description="Send the scrape to the next backend of the list too if the first one is slow (optional)"),
     ):
 
+    if hedge is None:
+        hedge = SCRAPE_HEDGE.lower() in TRUE_VALUES
+
     if not backend:
         backend = SCRAPE_BACKEND
 
@@ -323,22 +846,19 @@ async def scrape_post(
         backend = "jina"  # jina can be used without an API key
 
     options = backend.split(',')
-    if SCRAPE_BACKEND_ROTATE == "random": # Randomly select one of the options
-        # Split the string by comma to get a list of options
-        backend = random.choice(options)
-    else: # SCRAPE_BACKEND_ROTATE == "sequential":
-        global last_scrape_backend 
-        if last_scrape_backend != None:
-            last_scrape_backend = (last_scrape_backend + 1) % len(options)
-            backend = options[last_scrape_backend]
-        else:
-            last_scrape_backend = 0
-            backend = options[last_scrape_backend]
+    backend = await select_backend("scrape", options, SCRAPE_BACKEND_ROTATE)
+    set_request_backend(backend)
+
+    if backend not in scrape_backends:
+        raise HTTPException(status_code=400, detail=f"Invalid backend '{backend}'. Choose from {', '.join(scrape_backends)}.")
+
+    if hedge and len(set(options)) > 1:
+        return await hedged_call("scrape", backend, options, body, polite_scrape_handler, cache_control)
 
-    if backend not in ["jina", "firecrawl", "crawl4ai", "tavily", "scrapingant", "scrapingbee", "markdowner", "patchright"]:
-        raise HTTPException(status_code=400, detail=f"Invalid backend '{backend}'. Choose from 'jina', 'firecrawl', 'patchright', 'crawl4ai', 'scrapingant', 'scrapingbee', 'markdowner' or 'tavily.")
+    if FAILOVER.lower() in TRUE_VALUES:
+        return await failover_call("scrape", backend, options, body, polite_scrape_handler, cache_control)
 
-    result = await scrape_handler(body, backend)
+    result = await cached_call("scrape", backend, body, polite_scrape_handler, cache_control)
     
     return result
 
@@ -355,7 +875,7 @@ async def scrape_page_endpoint(body: PlaywrightServiceModel):
     url = str(body.url)
 
     request = FirecrawlScapeModel(url=url, formats=["markdown"], headers=body.headers, timeout=body.timeout)
-    scrapped_result = await scrape_post(request, None)
+    scrapped_result = await scrape_post(request, backend=None, cache_control=None, hedge=None)
 
     result = {}
     result['content'] = scrapped_result['data']['markdown'] # should be rawHtml, needs to update scrape_single to take more parameters
@@ -384,12 +904,14 @@ async def deep_research_endpoint(body: DeepResearchRequest):
 
     params = body.json(by_alias=True)
 
-    async with httpx.AsyncClient() as client:
+    client = get_http_client()
+    set_request_backend("firecrawl")
+    async with track_backend_call("deep-research", "firecrawl"):
         try:
             response = await client.post(endpoint, headers=headers, data=params, timeout=HTTP_TIMEOUT)
             response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
             endTime = time.time()
-            log_request("deep-research", body.topic, "firecrawl", endpoint, 0, endTime-startTime)
+            log_request("deep-research", body.topic, "firecrawl", endpoint, len(response.content), endTime-startTime)
             return response.json()
         except httpx.HTTPStatusError as e:
             raise HTTPException(status_code=e.response.status_code, detail=str(e))
@@ -410,7 +932,9 @@ async def deep_research_status_endpoint(id):
 
     endpoint = endpoint + f"/{id}"
 
-    async with httpx.AsyncClient() as client:
+    client = get_http_client()
+    set_request_backend("firecrawl")
+    async with track_backend_call("deep-research", "firecrawl"):
         try:
             response = await client.get(endpoint, headers=headers, timeout=HTTP_TIMEOUT)
             response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
@@ -447,12 +971,14 @@ async def extract_endpoint(body: ExtractRequest):
 
     params = body.json(by_alias=True)
 
-    async with httpx.AsyncClient() as client:
+    client = get_http_client()
+    set_request_backend("firecrawl")
+    async with track_backend_call("extract", "firecrawl"):
         try:
             response = await client.post(endpoint, headers=headers, data=params, timeout=HTTP_TIMEOUT)
             response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
             endTime = time.time()
-            log_request("extract", body.prompt, "firecrawl", endpoint, 0, endTime-startTime)
+            log_request("extract", body.prompt, "firecrawl", endpoint, len(response.content), endTime-startTime)
             return response.json()
         except httpx.HTTPStatusError as e:
             raise HTTPException(status_code=e.response.status_code, detail=str(e))
@@ -474,7 +1000,9 @@ async def extract_status_endpoint(id):
 
     endpoint = endpoint + f"/{id}"
 
-    async with httpx.AsyncClient() as client:
+    client = get_http_client()
+    set_request_backend("firecrawl")
+    async with track_backend_call("extract", "firecrawl"):
         try:
             response = await client.get(endpoint, headers=headers, timeout=HTTP_TIMEOUT)
             response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
@@ -504,15 +1032,1403 @@ class FirecrawlSearchModel(BaseModel):
     scrapeOptions: ScrapeOptions | None = None
  
 
+######## Backend config schema
+
+Scalar = Union[bool, int, float, str] # yml values are often quoted strings: "true", "60"
+
+
+class ConfigSection(BaseModel):
+    model_config = ConfigDict(extra='forbid', populate_by_name=True) # a typo is an error, not an ignored key
+
+
+class ClientConfig(ConfigSection):
+    http2: Scalar = None
+    max_connections: int = None
+    max_keepalive_connections: int = None
+    keepalive_expiry: float = None
+
+
+class CacheConfig(ConfigSection):
+    ttl: float
+
+
+class LimitsConfig(ConfigSection):
+    rate: float = 0
+    burst: float = None
+    concurrency: int = 0
+    max_wait: float = None
+
+
+class FanOutConfig(ConfigSection):
+    concurrency: int = None
+    host_concurrency: int = None
+
+
+class FailoverConfig(ConfigSection):
+    retryable_status: list[int] = None
+    non_retryable_status: list[int] = None
+
+
+class PolitenessConfig(ConfigSection):
+    concurrency: int = None
+    delay: float = None
+    robots: Scalar = None
+
+
+class RouterConfig(ConfigSection):
+    weight: float = 1
+
+
+class SearchOptions(ConfigSection):
+    scrape: Scalar = None # false if the backend can't return the content of the results
+
+
+class PollConfig(ConfigSection):
+    url: str # key of the url to poll in the answer
+    timeout: float = None
+    interval: float = None
+    backoff: float = None
+    max_interval: float = None
+
+
+class RequestConfig(ConfigSection):
+    method: Literal["GET", "POST", "get", "post"] = "GET"
+    url: str
+    headers: Union[dict, str] = None
+    parameters: Union[dict, str] = None
+    data: Any = None
+    timeout: Scalar = None
+    poll: PollConfig = Field(None, alias='_poll')
+
+
+class ListDirective(ConfigSection):
+    type: Literal["array", "object"] = Field(alias='_type')
+    path: str = Field('', alias='_path')
+    fields: Union[dict, str]
+
+
+class CoerceDirective(ConfigSection):
+    type: Literal[tuple(COERCE_TYPES)] = Field(alias='_type')
+    value: Any
+
+
+class BackendConfig(ConfigSection):
+    request: RequestConfig = None
+    response: dict
+    client: ClientConfig = None
+    cache: CacheConfig = None
+    limits: LimitsConfig = None
+    batch: FanOutConfig = None
+    failover: FailoverConfig = None
+    politeness: PolitenessConfig = None
+    router: RouterConfig = None
+    config: SearchOptions = None
+    direct: Scalar = None # built in, see direct_scrape
+    min_length: int = None
+
+
+def check_response(node, path: str):
+    """Check the `_type` directives of a response config"""
+    if isinstance(node, dict) and '_type' in node:
+        if node['_type'] not in ("array", "object", *COERCE_TYPES):
+            raise ValueError(f"{path}: unknown _type '{node['_type']}'")
+        try:
+            (ListDirective if node['_type'] in ("array", "object") else CoerceDirective).model_validate(node)
+        except ValidationError as e:
+            raise ValueError(f"{path}: {validation_errors(e)}")
+        check_response(node.get('fields'), f"{path}.fields")
+        check_response(node.get('value'), f"{path}.value")
+    elif isinstance(node, dict):
+        for key, value in node.items():
+            check_response(value, f"{path}.{key}")
+    elif isinstance(node, list):
+        for index, item in enumerate(node):
+            check_response(item, f"{path}[{index}]")
+
+
+def check_backend(name: str, config: dict):
+    """Validate a backend with the schema, ValueError with the first errors"""
+    try:
+        backend = BackendConfig.model_validate(config)
+        if backend.request is None and str(backend.direct).lower() not in TRUE_VALUES:
+            raise ValueError("request section missing")
+        if 'data' not in backend.response:
+            raise ValueError("response.data missing")
+        check_response(backend.response, "response")
+    except ValidationError as e:
+        raise ValueError(f"backend {name}: {validation_errors(e)}")
+    except ValueError as e:
+        raise ValueError(f"backend {name}: {e}")
+
+
+def validation_errors(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in item['loc']) or 'config'}: {item['msg']}" for item in error.errors()[:3])
+
+
 # load backends config
-with open("search_backends.yml") as f:
-    search_backends = yaml.safe_load(f)
+def load_backends(path: str, source: str = None) -> dict:
+    """Load a backends yml file, validate it with the schema and precompile its request and response templates. ValueError if it is invalid"""
+    if source is None:
+        with open(path) as f:
+            source = f.read()
+    try:
+        backends = yaml.safe_load(source)
+    except yaml.YAMLError as e:
+        raise ValueError(f"{path}: invalid YAML: {e}")
+    if not isinstance(backends, dict) or not all(isinstance(config, dict) for config in backends.values()):
+        raise ValueError(f"{path}: each backend must be a mapping of its config")
+
+    for name, backend_config in backends.items():
+        try:
+            check_backend(name, backend_config)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}")
+        for section in ('request', 'response'):
+            if section in backend_config:
+                backend_config[section] = compile_config(backend_config[section])
+                for error in template_errors(backend_config[section], f"{name}.{section}"):
+                    raise ValueError(f"{path}: {error}")
+    return backends
+
+
+def template_errors(config, path: str) -> list:
+    """Templates of a compiled config that failed to compile"""
+    if isinstance(config, CompiledTemplate):
+        return [f"{path}: {config.error}"] if config.error else []
+    if isinstance(config, Directive):
+        return template_errors(config.fields, f"{path}.fields") + template_errors(config.value, f"{path}.value")
+    if isinstance(config, dict):
+        return [error for key, value in config.items() for error in template_errors(value, f"{path}.{key}")]
+    if isinstance(config, list):
+        return [error for index, item in enumerate(config) for error in template_errors(item, f"{path}[{index}]")]
+    return []
+
+
+def template_variables(config) -> set:
+    """Names read by the templates of a compiled config"""
+    if isinstance(config, CompiledTemplate):
+        return set(config.names)
+    if isinstance(config, Directive):
+        return template_variables(config.fields) | template_variables(config.value)
+    if isinstance(config, dict):
+        return set().union(*(template_variables(value) for value in config.values()))
+    if isinstance(config, list):
+        return set().union(*(template_variables(item) for item in config))
+    return set()
+
+
+######## Render context
+
+template_env = MappingProxyType({}) # environment variables used by the templates, see build_template_env
+
+
+def build_template_env(configs: dict) -> MappingProxyType:
+    """The environment variables the request templates use (API keys, endpoints...) and the ones of TEMPLATE_ENV, read once.
+    The fields of the requests and the keys read from the answers are never taken from the environment"""
+    names = {name.strip() for name in TEMPLATE_ENV.split(',') if name.strip()}
+    answer_keys = {'processingTime'}
+    for backends in configs.values():
+        for backend_config in backends.values():
+            names |= template_variables(backend_config.get('request'))
+            answer_keys |= template_variables(backend_config.get('response'))
+    names -= answer_keys | set(FirecrawlScapeModel.model_fields) | set(FirecrawlSearchModel.model_fields) | set(BatchScrapeQuery.model_fields)
+    return MappingProxyType({name: os.environ[name] for name in sorted(names) if name in os.environ})
+
+
+def render_context(*layers: Mapping) -> ChainMap:
+    """Read-only context of the templates: the environment first, so the answer of a backend can't replace an API key,
+    then the layers. The layers are chained, not merged; Jinja still flattens the chain into a dict when it renders"""
+    return ChainMap(template_env, *layers)
+
+
+######## Config reload
+
+BACKEND_FILES = {"search": "search_backends.yml", "scrape": "scrape_backends.yml", "batch_scrape": "batch_scrape_backends.yml"}
+
+config_status = {"version": None, "loadedAt": None, "reloads": 0, "files": {}, "error": None}
+config_mtimes = {} # file -> mtime of the last version read, valid or not
+
+
+def read_configs() -> tuple:
+    """Load and compile all the backend files, run in a thread. Returns the backends per type and the version of each file"""
+    configs, files = {}, {}
+    for type, path in BACKEND_FILES.items():
+        with open(path, 'rb') as f:
+            source = f.read()
+        configs[type] = load_backends(path, source.decode())
+        files[path] = {"sha256": hashlib.sha256(source).hexdigest(), "modified": datetime.fromtimestamp(os.path.getmtime(path), timezone.utc).isoformat()}
+    return configs, files
+
+
+def apply_configs(configs: dict, files: dict):
+    """Swap the new configs in at once, between two requests, and reset what was built from the old ones"""
+    global search_backends, scrape_backends, batch_scrape_backends, template_env
+    previous = {"search": search_backends, "scrape": scrape_backends, "batch_scrape": batch_scrape_backends} if config_status['version'] else {}
+    search_backends, scrape_backends, batch_scrape_backends = configs["search"], configs["scrape"], configs["batch_scrape"]
+    template_env = build_template_env(configs)
+
+    for type, backends in previous.items():
+        for name, old in backends.items():
+            if configs[type].get(name) != old:
+                reset_backend(type, name)
+
+    config_status.update(
+        version=hashlib.sha256("".join(file['sha256'] for file in files.values()).encode()).hexdigest()[:12],
+        loadedAt=datetime.now(timezone.utc).isoformat(),
+        files=files,
+        error=None,
+    )
+
+
+def reset_backend(type: str, backend: str):
+    """Forget the limiter, semaphore and client of a changed backend, they are built again from its new config"""
+    backend_limiters.pop((type, backend), None)
+    backend_semaphores.pop(backend, None)
+    client = http_clients.pop((type, backend), None)
+    if client is not None:
+        retired_clients.add(client)
+        asyncio.get_running_loop().create_task(retire_client(client))
+
+
+retired_clients = set() # clients of the old configs, closed after the requests still using them
+
+
+async def retire_client(client: httpx.AsyncClient):
+    await asyncio.sleep(HTTP_TIMEOUT * 2)
+    retired_clients.discard(client)
+    await client.aclose()
+
+
+def config_files_changed() -> bool:
+    changed = False
+    for path in BACKEND_FILES.values():
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if config_mtimes.get(path) != mtime:
+            config_mtimes[path] = mtime
+            changed = True
+    return changed
+
+
+async def reload_configs(force: bool = False) -> bool:
+    """Load the changed configs in a thread and swap them in. An invalid config is reported and the current one is kept"""
+    if not config_files_changed() and not force:
+        return False
+    try:
+        configs, files = await asyncio.to_thread(read_configs)
+    except Exception as e: # ValueError of the checks, missing file...
+        config_status['error'] = {"message": str(e), "at": datetime.now(timezone.utc).isoformat()}
+        print(f"Backend config rejected, keeping version {config_status['version']}: {e}")
+        return False
+    if not config_status['error'] and all(config_status['files'].get(path, {}).get('sha256') == file['sha256'] for path, file in files.items()):
+        return False # touched, not changed
+    apply_configs(configs, files)
+    config_status['reloads'] += 1
+    print(f"Backend config reloaded, version {config_status['version']}")
+    return True
+
+
+async def watch_configs():
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+        try:
+            await reload_configs()
+        except Exception as e:
+            print(f"Backend config reload failed: {e}")
+
+
+search_backends, scrape_backends, batch_scrape_backends = {}, {}, {}
+config_files_changed()
+apply_configs(*read_configs())
+
+
+######## Shared state
+
+class MemoryStore:
+    """State of this process only, the default with a single worker"""
+
+    shared = False
+    name = "memory"
+
+    def __init__(self):
+        self.values = {} # key -> (expires, value)
+        self.buckets = {} # key -> [tokens, updated]
+
+    async def get(self, key: str):
+        """(expires, value) or None"""
+        entry = self.values.get(key)
+        if entry and entry[0] is not None and entry[0] < time.time():
+            del self.values[key]
+            return None
+        return entry
+
+    async def set(self, key: str, value: bytes, expires: float = None):
+        self.values[key] = (expires, value)
+
+    async def incr(self, key: str) -> int:
+        value = int((await self.get(key) or (None, 0))[1]) + 1
+        self.values[key] = (None, value)
+        return value
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        """Take a token of the bucket, return 0 or the seconds to wait for the next one"""
+        now = time.time()
+        tokens, updated = self.buckets.get(key, [burst, now])
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0 if tokens >= 1 else (1 - tokens) / rate
+        self.buckets[key] = [tokens - 1 if tokens >= 1 else tokens, now]
+        return wait
+
+    async def close(self):
+        pass
+
+
+class SQLiteStore:
+    """State in an SQLite file, shared by the workers of the same host"""
+
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = f"sqlite://{path}"
+        self.db = None
+        self.db_lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL") # readers don't block the writer of another worker
+            self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, expires REAL, value BLOB)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            self.db.execute("DELETE FROM state WHERE expires < ?", (time.time(),))
+        return self.db
+
+    def run(self, function, *args):
+        with self.db_lock:
+            return function(self.connect(), *args)
+
+    async def get(self, key: str):
+        def get(db):
+            return db.execute("SELECT expires, value FROM state WHERE key = ? AND (expires IS NULL OR expires >= ?)", (key, time.time())).fetchone()
+        return await asyncio.to_thread(self.run, get)
+
+    async def set(self, key: str, value: bytes, expires: float = None):
+        def set(db):
+            db.execute("INSERT OR REPLACE INTO state (key, expires, value) VALUES (?, ?, ?)", (key, expires, value))
+        await asyncio.to_thread(self.run, set)
+
+    async def incr(self, key: str) -> int:
+        def incr(db):
+            db.execute("BEGIN IMMEDIATE") # one worker at a time
+            try:
+                row = db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+                value = int(row[0]) + 1 if row else 1
+                db.execute("INSERT OR REPLACE INTO state (key, expires, value) VALUES (?, NULL, ?)", (key, value))
+            finally:
+                db.execute("COMMIT")
+            return value
+        return await asyncio.to_thread(self.run, incr)
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        def take_token(db):
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens, updated = row if row else (burst, now)
+                tokens = min(burst, tokens + (now - updated) * rate)
+                wait = 0 if tokens >= 1 else (1 - tokens) / rate
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens - 1 if tokens >= 1 else tokens, now))
+            finally:
+                db.execute("COMMIT")
+            return wait
+        return await asyncio.to_thread(self.run, take_token)
+
+    async def close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class RedisStore:
+    """State in a Redis compatible server (Redis, Valkey, KeyDB...), shared by every worker.
+    Minimal RESP client on a single connection, so no client library is needed"""
+
+    shared = True
+
+    # token bucket in one atomic step, the wait is returned as a string as Lua numbers are truncated to integers
+    TAKE_TOKEN = """
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + (now - (tonumber(bucket[2]) or now)) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+        return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        parsed = httpx.URL(url)
+        self.host = parsed.host or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = parsed.path.strip('/') or "0"
+        self.name = f"redis://{self.host}:{self.port}/{self.database}"
+        self.reader = None
+        self.writer = None
+        self.lock = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self.send(["AUTH", self.password])
+        await self.send(["SELECT", self.database])
+
+    async def send(self, *commands):
+        """Send the commands at once (pipelined) and read their replies"""
+        payload = bytearray()
+        for command in commands:
+            payload += f"*{len(command)}\r\n".encode()
+            for argument in command:
+                argument = argument if isinstance(argument, bytes) else str(argument).encode()
+                payload += f"${len(argument)}\r\n".encode() + argument + b"\r\n"
+        self.writer.write(payload)
+        await self.writer.drain()
+        return [await self.read_reply() for _ in commands]
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the state store")
+        prefix, value = line[:1], line[1:-2]
+        if prefix == b"+":
+            return value.decode()
+        if prefix == b"-":
+            raise RuntimeError(f"State store error: {value.decode()}")
+        if prefix == b":":
+            return int(value)
+        if prefix == b"$":
+            length = int(value)
+            return None if length < 0 else (await self.reader.readexactly(length + 2))[:-2]
+        if prefix == b"*":
+            length = int(value)
+            return None if length < 0 else [await self.read_reply() for _ in range(length)]
+        raise RuntimeError(f"Unexpected reply from the state store: {line!r}")
+
+    async def command(self, *commands):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock: # one request/reply exchange at a time on the connection
+            try:
+                if self.writer is None or self.writer.is_closing():
+                    await self.connect()
+                return await self.send(*commands)
+            except BaseException:
+                # cancelled or failed between a command and its reply: the reply would be read by the next command
+                self.disconnect()
+                raise
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def get(self, key: str):
+        value, ttl = await self.command(["GET", key], ["PTTL", key])
+        if value is None:
+            return None
+        return (time.time() + ttl / 1000 if ttl >= 0 else None, value)
+
+    async def set(self, key: str, value: bytes, expires: float = None):
+        if expires is None:
+            await self.command(["SET", key, value])
+        else:
+            await self.command(["SET", key, value, "PX", max(1, int((expires - time.time()) * 1000))])
+
+    async def incr(self, key: str) -> int:
+        return (await self.command(["INCR", key]))[0]
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        return float((await self.command(["EVAL", self.TAKE_TOKEN, 1, key, rate, burst, time.time()]))[0])
+
+    async def close(self):
+        self.disconnect()
+
+
+def build_state_store(url: str):
+    if url.startswith("redis://"):
+        return RedisStore(url)
+    if url.startswith("sqlite://"):
+        return SQLiteStore(url[len("sqlite://"):])
+    return MemoryStore()
+
+
+state_store = build_state_store(STATE_STORE)
+
+
+######## Response cache
+
+class ResponseCache:
+    """LRU cache of JSON responses capped in bytes, with an optional second tier in a state store (SQLite file, Redis...)"""
+
+    def __init__(self, max_size: int, tier = None):
+        self.max_size = max_size
+        self.tier = tier
+        self.entries = OrderedDict() # key -> (expires, serialized response)
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry and entry[0] < time.time():
+            self.discard(key)
+            entry = None
+        if entry:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return json.loads(entry[1])
+
+        if self.tier:
+            entry = await self.tier.get(f"cache:{key}")
+            if entry:
+                self.store(key, *entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return json.loads(entry[1])
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value, ttl: float):
+        data = json.dumps(value).encode()
+        expires = time.time() + ttl
+        self.store(key, expires, data)
+        if self.tier:
+            await self.tier.set(f"cache:{key}", data, expires)
+
+    def store(self, key: str, expires: float, data: bytes):
+        self.discard(key)
+        if len(data) > self.max_size:
+            return
+        self.entries[key] = (expires, data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= len(entry[1])
+
+    async def close(self):
+        if self.tier:
+            await self.tier.close()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "diskHits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "size": self.size,
+            "maxSize": self.max_size,
+            "tier": self.tier.name if self.tier else None,
+        }
+
 
-with open("scrape_backends.yml") as f:
-    scrape_backends = yaml.safe_load(f)
+# second tier: the CACHE_FILE, or the state store when it is shared by several workers
+response_cache = ResponseCache(CACHE_MAX_SIZE, SQLiteStore(CACHE_FILE) if CACHE_FILE else state_store if state_store.shared else None)
 
-with open("batch_scrape_backends.yml") as f:
-    batch_scrape_backends = yaml.safe_load(f)
+
+def request_key(type: str, backend: str, body: BaseModel) -> str:
+    """Key of a request: the backend and the normalized request body"""
+    payload = json.dumps([type, backend, body.model_dump(mode='json')], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+in_flight = {} # request key -> [task of the backend call shared by identical concurrent requests, number of waiters]
+
+
+async def coalesced_call(key: str, call):
+    """Run call() once for all the identical requests in flight, they all get the same result or error.
+    Each waiter gets its own copy of the result, so the changes of one request don't leak into the others"""
+    entry = in_flight.get(key)
+    if entry is None or entry[0].done() or entry[0].cancelling(): # a call being cancelled cannot be joined
+        entry = [asyncio.ensure_future(call()), 0]
+        in_flight[key] = entry
+
+        def done(task):
+            if in_flight.get(key) is entry:
+                del in_flight[key]
+            if not task.cancelled():
+                task.exception() # retrieved even if every client went away
+
+        entry[0].add_done_callback(done)
+    else:
+        print(f"Joining in-flight request {key[:12]}")
+
+    entry[1] += 1
+    try:
+        # a waiter being cancelled must not cancel the call the others are waiting for
+        result = await asyncio.shield(entry[0])
+        # the last waiter takes the result itself, the ones before it a copy
+        return copy.deepcopy(result) if entry[1] > 1 else result
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and not entry[0].done(): # nobody wants the result anymore
+            if in_flight.get(key) is entry:
+                del in_flight[key] # the next identical request starts a new call
+            entry[0].cancel()
+
+
+def is_success(result) -> bool:
+    return not isinstance(result, dict) or str(result.get('success')).lower() != 'false'
+
+
+async def cached_call(type: str, backend: str, body: BaseModel, handler, cache_control: str = None):
+    """Call the handler through the response cache of the backend"""
+    if "changeTracking" in (getattr(body, 'formats', None) or []):
+        # the change status is relative to the last version seen by this request: a cached or shared answer is stale
+        return await handler(body, backend)
+
+    ttl = float(get_backends(type).get(backend, {}).get('cache', {}).get('ttl', CACHE_TTL))
+    directives = [directive.strip().lower() for directive in (cache_control or '').split(',')]
+    use_cache = ttl > 0 and 'no-store' not in directives
+
+    key = request_key(type, backend, body)
+    if use_cache and 'no-cache' not in directives:
+        result = await response_cache.get(key)
+        if result is not None:
+            print(f"Cache hit for {type} with {backend}")
+            return result
+
+    async def call():
+        result = await handler(body, backend)
+        if use_cache and is_success(result): # don't keep failed scrapes
+            await response_cache.set(key, result, ttl)
+        return result
+
+    return await coalesced_call(key, call)
+
+
+@app.get("/admin/cache")
+async def cache_stats():
+    return response_cache.stats()
+
+
+@app.get("/admin/config")
+async def config_info():
+    """Version of the backend configs in use, and the error of the last rejected one"""
+    return {
+        **config_status,
+        "backends": {type: list(get_backends(type).keys()) for type in BACKEND_FILES},
+        "reloadInterval": CONFIG_RELOAD_INTERVAL,
+    }
+
+
+@app.post("/admin/config/reload")
+async def config_reload():
+    """Reload the backend configs now"""
+    reloaded = await reload_configs(force=True)
+    if config_status['error'] and not reloaded:
+        raise HTTPException(status_code=422, detail=config_status['error']['message'])
+    return {"reloaded": reloaded, "version": config_status['version']}
+
+
+######## Backend stats and hedging
+
+class BackendStats:
+    """Health of a backend: recent latencies, moving averages of latency and errors, circuit breaker"""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=BACKEND_STATS_WINDOW)
+        self.timeouts = deque(maxlen=BACKEND_STATS_WINDOW) # time of the recent timeouts
+        self.ewma_latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.opened_until = 0.0 # the circuit is open (backend ejected) until then
+
+    def record(self, duration: float, status: int = None):
+        """Record a finished call, status is the error code if it failed"""
+        self.requests += 1
+        failed = status is not None and (status >= 500 or status in (401, 403, 429))
+        self.error_rate = BACKEND_EWMA_ALPHA * failed + (1 - BACKEND_EWMA_ALPHA) * self.error_rate
+        if status is None or status == 504: # a timeout is a latency too
+            self.ewma_latency = duration if self.ewma_latency is None else BACKEND_EWMA_ALPHA * duration + (1 - BACKEND_EWMA_ALPHA) * self.ewma_latency
+        if status is None:
+            self.latencies.append(duration)
+        if status == 504:
+            self.timeouts.append(time.time())
+
+        if failed:
+            self.errors += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD: # also after a failed probe
+                self.opened_until = time.time() + CIRCUIT_BREAKER_COOLDOWN
+        else:
+            self.consecutive_failures = 0
+            self.opened_until = 0.0
+
+    def available(self) -> bool:
+        """False while the backend is ejected, after the cool-down requests probe it again"""
+        return time.time() >= self.opened_until
+
+    def score(self) -> float:
+        """Expected cost of a request, lower is better. Unknown backends score 0 to be tried first"""
+        if self.requests == 0:
+            return 0.0
+        latency = self.ewma_latency if self.ewma_latency is not None else HTTP_TIMEOUT # it never answered
+        recent_timeouts = sum(1 for timeout in self.timeouts if timeout > time.time() - 60)
+        return latency * (1 + self.in_flight) * (1 + recent_timeouts) / max(0.05, 1 - self.error_rate)
+
+    def probing(self) -> bool:
+        """The cool-down of an ejected backend is over, the next request tells if it is back"""
+        return self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD and self.available()
+
+    def percentile(self, p: float):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "inFlight": self.in_flight,
+            "ewmaLatency": None if self.ewma_latency is None else round(self.ewma_latency, 3),
+            "errorRate": round(self.error_rate, 3),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "recentTimeouts": len(self.timeouts),
+            "ejected": not self.available(),
+            "score": round(self.score(), 3),
+        }
+
+
+backend_stats = {} # (type, backend) -> BackendStats
+
+
+def get_backend_stats(type: str, backend: str) -> BackendStats:
+    return backend_stats.setdefault((type, backend), BackendStats())
+
+
+@asynccontextmanager
+async def track_backend_call(type: str, backend: str):
+    """Record the latency and outcome of a backend call"""
+    stats = get_backend_stats(type, backend)
+    labels = (metric_type(type), backend)
+    stats.in_flight += 1
+    metrics["upstream_in_flight"].inc(labels)
+    start = time.time()
+    try:
+        yield
+    except HTTPException as e:
+        stats.record(time.time() - start, e.status_code)
+        metrics["upstream_errors"].inc(labels + (e.status_code,))
+        raise
+    else:
+        stats.record(time.time() - start)
+    finally:
+        stats.in_flight -= 1
+        metrics["upstream_in_flight"].inc(labels, -1)
+        metrics["upstream_seconds"].observe(labels, time.time() - start)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    lines = []
+    for key, metric in metrics.items():
+        lines += metric.render(METRIC_LABELS.get(key, ("type", "backend")))
+
+    cache = response_cache.stats()
+    for name, help in (("hits", "Response cache hits"), ("diskHits", "Response cache hits from the disk tier"), ("misses", "Response cache misses"), ("evictions", "Response cache evictions")):
+        metric = "crawlrouter_cache_" + re.sub(r'([A-Z])', r'_\1', name).lower() + "_total"
+        lines += [f"# HELP {metric} {help}", f"# TYPE {metric} counter", f"{metric} {cache[name]}"]
+    lines += ["# HELP crawlrouter_cache_bytes Size of the in-memory response cache", "# TYPE crawlrouter_cache_bytes gauge", f"crawlrouter_cache_bytes {cache['size']}"]
+
+    lines += ["# HELP crawlrouter_log_dropped_total Log records dropped because the log queue was full", "# TYPE crawlrouter_log_dropped_total counter", f"crawlrouter_log_dropped_total {request_logger.dropped}"]
+
+    lines += ["# HELP crawlrouter_backend_ejected 1 while the circuit breaker of the backend is open", "# TYPE crawlrouter_backend_ejected gauge"]
+    for (type, backend), stats in backend_stats.items():
+        lines.append(f'crawlrouter_backend_ejected{{type="{metric_type(type)}",backend="{escape_label(backend)}"}} {int(not stats.available())}')
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/backends")
+async def backends_stats():
+    result = {f"{type}/{backend}": stats.to_dict() for (type, backend), stats in backend_stats.items()}
+    for (type, backend), limiter in backend_limiters.items():
+        if limiter is not None:
+            result.setdefault(f"{type}/{backend}", {})['limits'] = limiter.to_dict()
+    return result
+
+
+######## Rate limits
+
+class BackendLimiter:
+    """Token bucket and max concurrency of a backend. The requests over the limits wait their turn in a FIFO queue"""
+
+    def __init__(self, rate: float = 0, burst: float = None, concurrency: int = 0, max_wait: float = RATE_LIMIT_MAX_WAIT):
+        self.rate = rate # requests per second, 0 for no limit
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.concurrency = concurrency # 0 for no limit
+        self.in_flight = 0
+        self.max_wait = max_wait
+        self.waiters = deque()
+        self.timer = None
+        self.rejected = 0
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def can_run(self) -> bool:
+        self.refill()
+        return (not self.rate or self.tokens >= 1) and (not self.concurrency or self.in_flight < self.concurrency)
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+        self.in_flight += 1
+
+    def saturated(self) -> bool:
+        """A new request would have to wait"""
+        return any(not waiter.done() for waiter in self.waiters) or not self.can_run()
+
+    async def acquire(self):
+        if not self.waiters and self.can_run():
+            self.take()
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if waiter.done() and not waiter.cancelled(): # the slot came at the same time
+                self.release()
+            else:
+                waiter.cancel()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        """Give the free slots to the oldest waiters, and come back when the next token is due"""
+        while self.waiters:
+            if self.waiters[0].done(): # timed out or cancelled
+                self.waiters.popleft()
+                continue
+            if not self.can_run():
+                break
+            self.take()
+            self.waiters.popleft().set_result(None)
+
+        waiting_for_token = self.rate and self.tokens < 1 and (not self.concurrency or self.in_flight < self.concurrency)
+        if self.waiters and waiting_for_token and self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later((1 - self.tokens) / self.rate, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    def to_dict(self) -> dict:
+        self.refill()
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": round(self.tokens, 2),
+            "concurrency": self.concurrency,
+            "inFlight": self.in_flight,
+            "waiting": sum(1 for waiter in self.waiters if not waiter.done()),
+            "rejected": self.rejected,
+        }
+
+
+backend_limiters = {} # (type, backend) -> BackendLimiter, None when the backend has no limits
+
+
+def get_limiter(type: str, backend: str) -> BackendLimiter:
+    """Limiter of a backend from the `limits` section of its yml"""
+    key = (type, backend)
+    if key not in backend_limiters:
+        limits = get_backends(type).get(backend, {}).get('limits')
+        backend_limiters[key] = BackendLimiter(
+            rate=float(limits.get('rate', 0)),
+            burst=float(limits['burst']) if limits.get('burst') else None,
+            concurrency=int(limits.get('concurrency', 0)),
+            max_wait=float(limits.get('max_wait', RATE_LIMIT_MAX_WAIT)),
+        ) if limits else None
+    return backend_limiters[key]
+
+
+async def take_shared_token(key: str, limiter: BackendLimiter):
+    """Token of the bucket in the state store, TimeoutError if it does not come within max_wait"""
+    deadline = time.monotonic() + limiter.max_wait
+    while (wait := await state_store.take_token(key, limiter.rate, limiter.burst)) > 0:
+        if time.monotonic() + wait > deadline:
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(wait)
+
+
+@asynccontextmanager
+async def backend_slot(type: str, backend: str):
+    """Wait for the rate limit and the concurrency quota of the backend, 429 after max_wait"""
+    limiter = get_limiter(type, backend)
+    if limiter is None:
+        yield
+        return
+    try:
+        await limiter.acquire()
+    except asyncio.TimeoutError:
+        limiter.rejected += 1
+        raise HTTPException(status_code=429, detail=f"Backend {backend} is saturated, no slot after {limiter.max_wait}s")
+    if state_store.shared and limiter.rate:
+        # the local bucket only sees this worker, the rate of the backend is shared by all of them
+        try:
+            await take_shared_token(f"bucket:{type}:{backend}", limiter)
+        except asyncio.TimeoutError:
+            limiter.release()
+            limiter.rejected += 1
+            raise HTTPException(status_code=429, detail=f"Backend {backend} is saturated, no slot after {limiter.max_wait}s")
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+######## Failover
+
+def is_retryable(type: str, backend: str, status_code: int) -> bool:
+    """Status codes worth another backend, set per backend in the `failover` section of the yml"""
+    failover_config = get_backends(type).get(backend, {}).get('failover', {})
+    retryable = [int(status) for status in failover_config.get('retryable_status', FAILOVER_STATUS)]
+    non_retryable = [int(status) for status in failover_config.get('non_retryable_status', [])]
+    return status_code in retryable and status_code not in non_retryable
+
+
+async def failover_call(type: str, backend: str, options: list, body: BaseModel, handler, cache_control: str = None):
+    """Try the backend, then the next ones of the list, until one answers within the timeout of the request"""
+    backends = get_backends(type)
+    following = options[options.index(backend) + 1:] + options[:options.index(backend)]
+    chain = [backend] + [
+        option for option in dict.fromkeys(following)
+        if option != backend and option in backends and get_backend_stats(type, option).available()
+    ]
+
+    timeout = getattr(body, 'timeout', None)
+    deadline = time.monotonic() + timeout / 1000 if timeout else None
+    error = None
+    unsuccessful = None # answer of a backend that failed to scrape, returned if nothing better comes
+    for attempt, option in enumerate(chain, 1):
+        remaining = deadline - time.monotonic() if deadline else None
+        if remaining is not None and remaining <= 0:
+            break
+        # the next backends only get the time that is left
+        attempt_body = body if attempt == 1 or remaining is None else body.model_copy(update={'timeout': int(remaining * 1000)})
+        try:
+            result = await asyncio.wait_for(cached_call(type, option, attempt_body, handler, cache_control), remaining)
+        except asyncio.TimeoutError:
+            error = HTTPException(status_code=504, detail=f"Timeout: {option} did not answer in time")
+        except HTTPException as e:
+            if not is_retryable(type, option, e.status_code):
+                raise
+            error = e
+        else:
+            result = {**result, 'backend': option, 'attempts': attempt}
+            if is_success(result):
+                return result
+            unsuccessful = result
+
+        if attempt < len(chain):
+            print(f"Failing over {type} from {option} to {chain[attempt]}")
+
+    if unsuccessful is not None:
+        return unsuccessful
+    raise error or HTTPException(status_code=504, detail="Timeout exceeded")
+
+
+######## Backend selection
+
+ROUTING_POLICIES = ["least-latency", "p2c", "weighted"]
+
+
+async def select_backend(type: str, options: list, rotate: str) -> str:
+    """Pick a backend of the comma-separated list with the rotation mode"""
+    if rotate in ROUTING_POLICIES:
+        backend = route_backend(type, options, rotate)
+    elif rotate == "random": # Randomly select one of the options
+        backend = random.choice(options)
+    else: # sequential, the counter is in the state store to be shared by the workers
+        counter = "search" if type == "search" else "scrape"
+        backend = options[(await state_store.incr(f"rotation:{counter}") - 1) % len(options)]
+
+    return skip_saturated(type, options, backend)
+
+
+def skip_saturated(type: str, options: list, backend: str) -> str:
+    """If the backend is at its rate or concurrency limit, the next idle and healthy backend of the list"""
+    limiter = get_limiter(stats_type(type, backend), backend)
+    if limiter is None or not limiter.saturated():
+        return backend
+
+    index = options.index(backend)
+    for option in options[index + 1:] + options[:index]:
+        option_type = stats_type(type, option)
+        if option == backend or option not in get_backends(option_type) or not get_backend_stats(option_type, option).available():
+            continue
+        option_limiter = get_limiter(option_type, option)
+        if option_limiter is None or not option_limiter.saturated():
+            return option
+    return backend # every backend is busy: wait in the queue of the selected one
+
+
+def stats_type(type: str, backend: str) -> str:
+    """Batch scrapes use the batch API of a backend if it has one, its scrape API otherwise"""
+    if type == "batch_scrape" and backend not in batch_scrape_backends:
+        return "scrape"
+    return type
+
+
+def route_backend(type: str, options: list, policy: str) -> str:
+    """Health-aware selection: ejected backends are skipped, then least-latency, power of two choices or weighted"""
+    candidates = list(dict.fromkeys(options))
+    stats = {option: get_backend_stats(stats_type(type, option), option) for option in candidates}
+    available = [option for option in candidates if stats[option].available()]
+    if not available: # every backend is ejected: the first one to come back
+        return min(candidates, key=lambda option: stats[option].opened_until)
+
+    for option in available:
+        if stats[option].probing(): # a single probe, the others keep away until it is back
+            stats[option].opened_until = time.time() + CIRCUIT_BREAKER_COOLDOWN
+            return option
+
+    if policy == "least-latency":
+        return min(available, key=lambda option: stats[option].score())
+
+    if policy == "p2c":
+        if len(available) == 1:
+            return available[0]
+        first, second = random.sample(available, 2)
+        return first if stats[first].score() <= stats[second].score() else second
+
+    # weighted: static weight from the yml divided by the expected cost
+    weights = [
+        float(get_backends(stats_type(type, option)).get(option, {}).get('router', {}).get('weight', 1)) / max(0.01, stats[option].score())
+        for option in available
+    ]
+    return random.choices(available, weights=weights)[0]
+
+
+def hedge_delay(type: str, backend: str) -> float:
+    """Time to wait for a backend before hedging: a high percentile of its latency"""
+    stats = get_backend_stats(type, backend)
+    if len(stats.latencies) < 20: # not enough samples yet
+        return SCRAPE_HEDGE_DELAY
+    return stats.percentile(SCRAPE_HEDGE_PERCENTILE)
+
+
+async def hedged_call(type: str, backend: str, options: list, body: BaseModel, handler, cache_control: str = None):
+    """Call the backend, and if it is slower than usual the next backend of the list as well.
+    The first good answer wins and the other call is cancelled"""
+    backends = get_backends(type)
+    following = options[options.index(backend) + 1:] + options[:options.index(backend)]
+    secondary = next((option for option in following if option != backend and option in backends), None)
+    if secondary is None:
+        return {**await cached_call(type, backend, body, handler, cache_control), 'backend': backend, 'attempts': 1}
+
+    tasks = {asyncio.ensure_future(cached_call(type, backend, body, handler, cache_control)): backend}
+
+    def answer(task):
+        # as failover_call, tell which backend answered and how many were called
+        return {**task.result(), 'backend': tasks[task], 'attempts': len(tasks)}
+
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay(type, backend))
+        if done:
+            task = next(iter(done))
+            if task.exception() is None and is_success(task.result()):
+                return answer(task)
+
+        print(f"Hedging {type} from {backend} to {secondary}")
+        tasks[asyncio.ensure_future(cached_call(type, secondary, body, handler, cache_control))] = secondary
+
+        pending = {task for task in tasks if not task.done()}
+        last = next(iter(done)) if done else None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and is_success(task.result()):
+                    return answer(task)
+                last = task
+        return answer(last) # every backend failed: the last error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+######## Change tracking
+
+class ContentStore:
+    """Last version of the scraped pages: validators (ETag, Last-Modified), hashes and document, in SQLite.
+    The file is created by the first tracked page"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self.db_lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return self.db is not None or os.path.exists(self.path)
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, url TEXT, etag TEXT, last_modified TEXT,
+                body_hash TEXT, hash TEXT, document TEXT, scraped REAL)""")
+            self.db.commit()
+        return self.db
+
+    def get(self, key: str) -> dict:
+        with self.db_lock:
+            if not self.exists():
+                return None
+            cursor = self.connect().execute("SELECT * FROM pages WHERE key = ? AND scraped >= ?", (key, time.time() - CONTENT_TTL))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            page = dict(zip([column[0] for column in cursor.description], row))
+            page['document'] = json.loads(page['document'])
+            return page
+
+    def set(self, key: str, url: str, etag: str, last_modified: str, body_hash: str, hash: str, document: dict):
+        with self.db_lock:
+            db = self.connect()
+            db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key, url, etag, last_modified, body_hash, hash, json.dumps(document), time.time()))
+            db.commit()
+
+    def clean(self):
+        with self.db_lock:
+            if not self.exists():
+                return
+            db = self.connect()
+            db.execute("DELETE FROM pages WHERE scraped < ?", (time.time() - CONTENT_TTL,))
+            db.commit()
+
+    def close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+content_store = ContentStore(CONTENT_FILE)
+
+
+def content_key(request: FirecrawlScapeModel, backend: str) -> str:
+    """A page is compared with its previous scrape by the same backend with the same options"""
+    options = request.model_dump(mode='json', include={'url', 'formats', 'onlyMainContent', 'includeTags', 'excludeTags', 'removeBase64Images', 'mobile', 'location'})
+    return hashlib.sha256(json.dumps([backend, options], sort_keys=True).encode()).hexdigest()
+
+
+async def track_changes(request: FirecrawlScapeModel, backend: str, result: dict, previous: dict, info: dict) -> dict:
+    """Add changeTracking to the document, as Firecrawl, and keep it as the last version of the page"""
+    document = result.get('data') if isinstance(result, dict) else None
+    if not isinstance(document, dict):
+        return result
+    document.pop('changeTracking', None) # the one of the backend, if any
+    content = document.get('markdown') or document.get('html') or document.get('rawHtml') or ""
+    hash = hashlib.sha256(content.encode()).hexdigest()
+    if previous is None:
+        status = "new"
+    else:
+        status = "same" if hash == previous['hash'] else "changed"
+    await asyncio.to_thread(content_store.set, content_key(request, backend), str(request.url),
+                            info.get('etag'), info.get('last_modified'), info.get('body_hash'), hash, document)
+    document['changeTracking'] = {
+        "previousScrapeAt": datetime.fromtimestamp(previous['scraped'], timezone.utc).isoformat() if previous else None,
+        "changeStatus": status,
+        "visibility": "visible",
+    }
+    return result
+
+
+######## Direct scrape
+
+NOISE_TAGS = ["script", "style", "noscript", "iframe", "svg", "template", "canvas", "object", "embed"]
+# removed with onlyMainContent, as Firecrawl
+BOILERPLATE_TAGS = ["header", "footer", "nav", "aside", "form", "dialog"]
+BOILERPLATE_PATTERN = re.compile(r'(^|[-_ ])(nav|navbar|menu|sidebar|footer|header|cookie|consent|banner|breadcrumbs?|social|share|popup|modal|newsletter|advert|ads?|related|comments?)([-_ ]|$)', re.I)
+
+direct_pool = None
+
+
+def html_to_document(html: str, url: str, options: dict) -> tuple:
+    """Firecrawl document of an HTML page and the length of its text before the filters. CPU bound, run in the process pool"""
+    soup = BeautifulSoup(html, "html.parser")
+    description = soup.find("meta", attrs={"name": "description"})
+    language = soup.html.get("lang") if soup.html else None
+    metadata = {
+        "title": soup.title.get_text(strip=True) if soup.title else "",
+        "description": description.get("content", "") if description else "",
+        "language": language,
+        "sourceURL": options['sourceURL'],
+        "url": url,
+        "statusCode": options['statusCode'],
+    }
+
+    for tag in soup(NOISE_TAGS):
+        tag.decompose()
+    root = soup.body or soup
+    text_length = len(root.get_text(strip=True))
+
+    if options.get('includeTags'):
+        root = BeautifulSoup("".join(str(tag) for tag in root.select(", ".join(options['includeTags']))), "html.parser")
+    elif options.get('onlyMainContent'):
+        root = root.find("main") or root.find("article") or root.find(attrs={"role": "main"}) or root
+        for tag in root(BOILERPLATE_TAGS):
+            tag.decompose()
+        for tag in root.find_all(lambda tag: tag.attrs is not None and BOILERPLATE_PATTERN.search(" ".join(tag.get("class", [])) + " " + tag.get("id", ""))):
+            if not tag.decomposed:
+                tag.decompose()
+    for selector in options.get('excludeTags') or []:
+        for tag in root.select(selector):
+            tag.decompose()
+
+    # absolute links and images, as Firecrawl
+    for tag in root.find_all(href=True):
+        tag['href'] = urljoin(url, tag['href'])
+    for tag in root.find_all("img", src=True):
+        if tag['src'].startswith("data:"):
+            if options.get('removeBase64Images'):
+                tag['src'] = "<Base64-Image-Removed>"
+        else:
+            tag['src'] = urljoin(url, tag['src'])
+
+    formats = options.get('formats') or ["markdown"]
+    document = {"markdown": md(str(root), heading_style="ATX").strip()}
+    if "html" in formats:
+        document['html'] = str(root)
+    if "rawHtml" in formats:
+        document['rawHtml'] = html
+    if "links" in formats:
+        document['links'] = list(dict.fromkeys(tag['href'] for tag in root.find_all("a", href=True) if tag['href'].startswith("http")))
+    document['metadata'] = metadata
+    return document, text_length
+
+
+async def convert_html(html: str, url: str, options: dict) -> tuple:
+    """Convert out of the event loop: in a process (the GIL would block the loop with a thread), or a thread if DIRECT_PROCESSES=0"""
+    global direct_pool
+    if DIRECT_PROCESSES <= 0:
+        return await asyncio.to_thread(html_to_document, html, url, options)
+    if direct_pool is None:
+        # spawn: forking a process that runs threads and an event loop is not safe
+        direct_pool = ProcessPoolExecutor(DIRECT_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return await asyncio.get_running_loop().run_in_executor(direct_pool, html_to_document, html, url, options)
+
+
+async def check_public_url(url: httpx.URL):
+    """Refuse the urls whose host resolves to a private, loopback, link-local or reserved address,
+    so the direct backend can't be used to reach the internal network (SSRF)"""
+    if url.scheme not in ("http", "https"):
+        raise HTTPException(status_code=400, detail=f"Unsupported url scheme for a direct scrape: {url.scheme}")
+    if DIRECT_ALLOW_PRIVATE.lower() in TRUE_VALUES:
+        return
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(url.host, url.port or (443 if url.scheme == "https" else 80), type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise HTTPException(status_code=502, detail=f"Cannot resolve {url.host}: {str(e)}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%')[0]) # without the IPv6 scope
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise HTTPException(status_code=403, detail=f"Direct scrape of a non public address refused: {url.host} ({ip})")
+
+
+async def direct_scrape(request: FirecrawlScapeModel, config: dict, client: httpx.AsyncClient, info: dict, min_length: int = 0, previous: dict = None) -> dict:
+    """Fetch the page with the pooled client and convert it here, for the `direct` backends.
+    With the previous version of the page, the request is conditional and an unchanged page is not converted again"""
+    headers = {**config.get('headers', {}), **(request.headers or {})}
+    if previous:
+        if previous['etag']:
+            headers['If-None-Match'] = previous['etag']
+        if previous['last_modified']:
+            headers['If-Modified-Since'] = previous['last_modified']
+    timeout = int(config.get('timeout', 10000)) / 1000
+    try:
+        upstream = client.build_request("GET", config['url'], headers=headers, timeout=timeout)
+        # the redirects are followed here, each of them is checked as the first url
+        for _ in range(DIRECT_MAX_REDIRECTS + 1):
+            await check_public_url(upstream.url)
+            response = await client.send(upstream, stream=True)
+            if not (response.is_redirect and response.next_request):
+                break
+            await response.aclose()
+            upstream = response.next_request
+        else:
+            raise HTTPException(status_code=500, detail=f"Request error: more than {DIRECT_MAX_REDIRECTS} redirects")
+        try:
+            if response.status_code == 304 and previous:
+                info.update(etag=previous['etag'], last_modified=previous['last_modified'], body_hash=previous['body_hash'])
+                return {"success": True, "data": previous['document']}
+            response.raise_for_status()
+            body = await read_body(response)
+        finally:
+            await response.aclose()
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"Timeout: {str(e)}")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Request error: {str(e)}")
+    info['size'] = len(body)
+    info.update(etag=response.headers.get('etag'), last_modified=response.headers.get('last-modified'), body_hash=hashlib.sha256(body).hexdigest())
+    if previous and previous['body_hash'] == info['body_hash']: # no validators, but the same page
+        return {"success": True, "data": previous['document']}
+
+    content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+    text = body.decode(response.encoding or 'utf-8', errors='replace')
+    if content_type in ("text/plain", "text/markdown"):
+        document = {"markdown": text, "metadata": {"sourceURL": str(request.url), "url": str(response.url), "statusCode": response.status_code}}
+        text_length = None # no JavaScript to run
+    elif content_type in ("text/html", "application/xhtml+xml", ""):
+        options = {**request.model_dump(mode='json', include={'formats', 'onlyMainContent', 'includeTags', 'excludeTags', 'removeBase64Images'}),
+                   'sourceURL': str(request.url), 'statusCode': response.status_code}
+        document, text_length = await convert_html(text, str(response.url), options)
+    else: # pdf, images... are left to the other backends
+        raise HTTPException(status_code=415, detail=f"Unsupported content type for a direct scrape: {content_type}")
+
+    # pages rendered with JavaScript are nearly empty without it, the next backend of the list renders them
+    if text_length is not None and text_length < min_length:
+        raise HTTPException(status_code=422, detail=f"Page text shorter than {min_length} characters, it probably needs JavaScript")
+    return {"success": True, "data": document}
 
 
 ##############  handler scrape requests
@@ -521,33 +2437,37 @@ async def scrape_handler(request: FirecrawlScapeModel, backend: str):
     
     startTime = time.time()
 
-    # Merge environment variables with request variables    
-    context = {**os.environ, **(request.model_dump())}
+    # environment variables of the templates and request variables
+    context = render_context(request.model_dump(mode='json'))
         
     backend_config = scrape_backends.get(backend, {})
 
     request_config = backend_config.get('request', {})
     response_config = backend_config.get('response', {})
 
-    request_config = await render_config(
-        request_config,
-        context,
-    )
+    request_config = await timed_render_config("scrape", backend, request_config, context)
     
 
+    tracking = "changeTracking" in (request.formats or [])
+    previous = await asyncio.to_thread(content_store.get, content_key(request, backend)) if tracking else None
+
     # Make API call
-    response =  await make_api_call(request_config)
+    info = {}
+    async with backend_slot("scrape", backend), track_backend_call("scrape", backend):
+        if str(backend_config.get('direct')).lower() in TRUE_VALUES:
+            response = await direct_scrape(request, request_config, get_http_client("scrape", backend), info, int(backend_config.get('min_length', 0)), previous)
+        else:
+            response =  await make_api_call(request_config, get_http_client("scrape", backend), info)
             
     endTime = time.time()
     
-    context = {**os.environ, **(response), 'processingTime': round(endTime-startTime, 3)}
+    context = render_context({'processingTime': round(endTime-startTime, 3)}, response)
     # Process response
-    processed_response = await render_config(
-        response_config,
-        context,
-    )
+    processed_response = await timed_render_config("scrape", backend, response_config, context)
+    if tracking and is_success(processed_response):
+        processed_response = await track_changes(request, backend, processed_response, previous, info)
 
-    log_request("scrape", str(request.url), backend, request_config['url'], 0, round(endTime-startTime, 3))
+    log_request("scrape", str(request.url), backend, request_config['url'], info.get('size', 0), round(endTime-startTime, 3))
     return processed_response
         
 ##############  handler scrape requests
@@ -555,51 +2475,58 @@ async def scrape_handler(request: FirecrawlScapeModel, backend: str):
 
 
 ##############  handler search requests
-async def search_handler(request: FirecrawlSearchModel, backend: str):
+async def search_results(request: FirecrawlSearchModel, backend: str):
     print(f"Searching {request.query} with {backend}")
 
     startTime = time.time()
 
-    # Merge environment variables with request variables    
-    context = {**os.environ, **(request.model_dump())}
+    # environment variables of the templates and request variables
+    context = render_context(request.model_dump(mode='json'))
         
     backend_config = search_backends.get(backend, {})
 
     request_config = backend_config.get('request', {})
     response_config = backend_config.get('response', {})
 
-    request_config = await render_config(
-        request_config,
-        context,
-    )
+    request_config = await timed_render_config("search", backend, request_config, context)
     
     # Make API call
-    response =  await make_api_call(request_config)
+    async with backend_slot("search", backend), track_backend_call("search", backend):
+        response =  await make_api_call(request_config, get_http_client("search", backend))
             
     endTime = time.time()
-    #context = {**os.environ, **(response), **({'processingTime': round(endTime-startTime, 3)})}
-    context = {**os.environ, **(response), 'processingTime': round(endTime-startTime, 3)}
+    context = render_context({'processingTime': round(endTime-startTime, 3)}, response)
     # Process response
-    processed_response = await render_config(
-        response_config,
-        context,
-    )
+    processed_response = await timed_render_config("search", backend, response_config, context)
+
+    if isinstance(processed_response.get('data'), list):
+        processed_response['data'] = processed_response['data'][:request.limit] # some search engine, like searxng don't handle limit
+    return processed_response
 
-    processed_response['data'] = processed_response['data'][:request.limit] # some search engine, like searxng don't handle limit
 
+def search_needs_scrape(request: FirecrawlSearchModel, backend: str) -> bool:
+    """True if the user wants the content of the results and the backend can't return it"""
     if request.scrapeOptions and request.scrapeOptions.formats: # user want to scrape all the results
-        config = backend_config.get('config', {})
+        config = search_backends.get(backend, {}).get('config', {})
         # print(config)
         # print(config['scrape'])
         # print(config['scrape'].lower() in ['true', '1', 'y', 'yes'])
-        if config and 'scrape' in config and (config['scrape'].lower() in ['false', '0', 'n', 'yes']): # the backend does not handle the scrape
-            #print('do the scrape')
-            #print(request.scrapeOptions.formats)
-            all_urls = [item['url'] for item in processed_response['data']]
-            #print(all_urls)
-            batch_scrape_request = BatchScrapeQuery(urls=all_urls, formats=request.scrapeOptions.formats)
-            scrapped_page = await batch_scrape_post(batch_scrape_request, backend=None)
-            processed_response['data'] = combined_search_scrape(processed_response, scrapped_page['data'])
+        if config and 'scrape' in config and str(config['scrape']).lower() not in TRUE_VALUES: # the backend does not handle the scrape
+            return True
+    return False
+
+
+async def search_handler(request: FirecrawlSearchModel, backend: str):
+    processed_response = await search_results(request, backend)
+
+    if search_needs_scrape(request, backend):
+        #print('do the scrape')
+        #print(request.scrapeOptions.formats)
+        all_urls = [item['url'] for item in processed_response['data']]
+        #print(all_urls)
+        batch_scrape_request = BatchScrapeQuery(urls=all_urls, formats=request.scrapeOptions.formats)
+        scrapped_page = await batch_scrape_post(batch_scrape_request, backend=None, stream=None, async_job=False)
+        processed_response['data'] = combined_search_scrape(processed_response, scrapped_page['data'])
 
     return processed_response
         
@@ -611,6 +2538,8 @@ async def search_handler(request: FirecrawlSearchModel, backend: str):
 async def search_post(
     body: FirecrawlSearchModel,
     backend: Optional[str] = Query(None, description="Backend to use (optional)"),
+    cache_control: Optional[str] = Header(None, description="no-cache to bypass the cache, no-store to not cache the response"),
+    stream: Optional[Literal["ndjson", "sse"]] = Query(None, description="Stream each result as soon as it is scraped (optional)"),
     ):
 
     # scrapeOptions = dict(body.scrapeOptions)
@@ -624,58 +2553,88 @@ async def search_post(
         backend = SEARCH_BACKEND
 
     options = backend.split(',')
-    if SEARCH_BACKEND_ROTATE == "random": # Randomly select one of the options
-        # Split the string by comma to get a list of options
-        backend = random.choice(options)
-    else: # we assume that SEARCH_BACKEND_ROTATE == "sequential":
-        global last_search_backend 
-        if last_search_backend != None:
-            last_search_backend = (last_search_backend + 1) % len(options)
-            backend = options[last_search_backend]
-        else:
-            last_search_backend = 0
-            backend = options[last_search_backend]
+    backend = await select_backend("search", options, SEARCH_BACKEND_ROTATE)
+    set_request_backend(backend)
 
-    if backend not in ["google", "searxng", "brave", "firecrawl", "serpapi", "tavily", "serping"]:
-        raise HTTPException(status_code=400, detail=f"Invalid backend '{backend}'. Choose from 'google', 'searxng', 'serping', 'brave', 'firecrawl', 'serpapi' or 'tavily'.")
+    if backend not in search_backends:
+        raise HTTPException(status_code=400, detail=f"Invalid backend '{backend}'. Choose from {', '.join(search_backends)}.")
 
-    return await search_handler(body, backend)    
+    if stream:
+        return stream_response(search_stream(body, backend), stream)
 
+    if FAILOVER.lower() in TRUE_VALUES:
+        return await failover_call("search", backend, options, body, search_handler, cache_control)
 
-######## Batch scrape
+    return await cached_call("search", backend, body, search_handler, cache_control)
 
-class BatchScrapeQuery(BaseModel):
-    urls: list[HttpUrl]
-    formats: list[Literal["markdown", "html", "rawHtml", "links", "screenshot", "screenshot@fullPage", "json"]] = ["markdown"]
-    onlyMainContent: bool = True
-    includeTags: list[str] = None
-    excludeTags: list[str] = None
-    headers: dict = None
-    waitFor: NonNegativeInt = 0
-    mobile: bool = False
-    skipTlsVerification: bool = False
-    timeout: NonNegativeInt = 30000
-    jsonOptions: dict = None
-    actions: list[dict] = None
-    location: dict = None # {"country": "US", "languages":"en-US"}
-    removeBase64Images: bool = False
-    blockAds: bool = True
-    proxy: Literal["basic", "stealth"] = None
 
+##############  handler batch scrape requests
+def retry_after(response: httpx.Response):
+    """Delay in seconds asked by the Retry-After header, if any"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+async def poll_job(url: str, headers: dict, poll_config: dict, timeout: float, client: httpx.AsyncClient, info: dict = None):
+    """Poll a job until it is completed, with exponential backoff and jitter between polls.
+    Yield the status of each poll, the last one is the completed job. info (optional) receives the size of the last poll"""
+    interval = float(poll_config.get('interval', 1))
+    max_interval = float(poll_config.get('max_interval', 10))
+    backoff = float(poll_config.get('backoff', 2))
+    deadline = time.monotonic() + timeout
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise HTTPException(status_code=504, detail="Timeout exceeded")
 
+        try:
+            async with client.stream("GET", url, headers=headers, timeout=min(HTTP_TIMEOUT, remaining)) as response:
+                body = await read_body(response)
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=500, detail=f"Request error: {str(e)}")
 
-##############  handler batch scrape requests
-async def batch_scrape_handler(request: BatchScrapeQuery, backend: str):
+        if response.status_code not in (429, 503): # rate limited or busy: wait and poll again
+            if response.is_error:
+                raise HTTPException(status_code=response.status_code, detail=f"Polling error: {body.decode(errors='replace')}")
+            result = parse_body(body, response.encoding)
+            if info is not None:
+                info['size'] = len(body)
+            yield result
+            if result.get("status") == "completed":
+                return
+            if result.get("status") == "failed":
+                raise HTTPException(status_code=502, detail=f"Batch job failed: {result}")
+
+        delay = retry_after(response)
+        if delay is None:
+            delay = interval / 2 + random.uniform(0, interval / 2)
+            interval = min(interval * backoff, max_interval)
+        await asyncio.sleep(min(delay, max(0, deadline - time.monotonic())))
+
+
+async def batch_scrape_progress(request: BatchScrapeQuery, backend: str, progress: bool = False, poll_timeout: float = None):
+    """Yield the processed response of the batch job, and with progress its partial results while polling.
+    poll_timeout (optional) overrides the polling deadline of the request, in seconds"""
     urls = [str(http_url) for http_url in request.urls]
     print(f"Scraping {urls} with {backend}")
    
     startTime = time.time()
+    timeout_set = 'timeout' in request.model_fields_set
  
-    request = request.model_dump() 
-    request['urls'] = urls # hack to convert HttpUrl to str
+    request = request.model_dump(mode='json')
     
-    # Merge environment variables with request variables  
-    context = {**os.environ, **request}
+    # environment variables of the templates and request variables
+    context = render_context(request)
         
     backend_config = batch_scrape_backends.get(backend, {})
 
@@ -683,13 +2642,13 @@ async def batch_scrape_handler(request: BatchScrapeQuery, backend: str):
     response_config = backend_config.get('response', {})
     poll_config = request_config.get('_poll', {})
 
-    request_config = await render_config(
-        request_config,
-        context,
-    )
+    request_config = await timed_render_config("batch_scrape", backend, request_config, context)
     
     # Make API call
-    response =  await make_api_call(request_config)
+    client = get_http_client("batch_scrape", backend)
+    info = {}
+    async with backend_slot("batch_scrape", backend), track_backend_call("batch_scrape", backend):
+        response =  await make_api_call(request_config, client, info)
     
     #print(poll_config)
 
@@ -701,85 +2660,631 @@ async def batch_scrape_handler(request: BatchScrapeQuery, backend: str):
         #print(f"polling {result_url}")
 
 
-        timeout = int(poll_config['timeout'])
-        start_poll = time.time()
-        while True:
-            if time.time() - start_poll > timeout:
-                raise HTTPException(status_code=400, detail="Timeout exceeded")
-
-            result = await make_request(result_url, headers=request_config['headers'], method="GET")
-
-            if result["status"] == "completed":
-                response = result
-                break
-                
-            time.sleep(int(poll_config['interval']))
+        # the yml timeout (s) bounds the polling, unless the client sent its own timeout (ms)
+        timeout = request['timeout'] / 1000 if timeout_set and request.get('timeout') else float(poll_config.get('timeout', 60))
+        if poll_timeout is not None:
+            timeout = poll_timeout
+        async for response in poll_job(result_url, request_config.get('headers'), poll_config, timeout, client, info):
+            if progress and response.get("status") != "completed":
+                context = render_context({'processingTime': round(time.time()-startTime, 3)}, response)
+                yield await timed_render_config("batch_scrape", backend, response_config, context)
     
             
     endTime = time.time()
     
-    context = {**os.environ, **(response), 'processingTime': round(endTime-startTime, 3)}
+    context = render_context({'processingTime': round(endTime-startTime, 3)}, response)
     # Process response
-    processed_response = await render_config(
-        response_config,
-        context,
-    )
+    processed_response = await timed_render_config("batch_scrape", backend, response_config, context)
 
     #print(f"scrape done")
-    log_request("scrape", urls, backend, request_config['url'], 0, round(endTime-startTime, 3))
+    log_request("scrape", urls, backend, request_config['url'], info.get('size', 0), round(endTime-startTime, 3))
+    yield processed_response
+
+
+async def batch_scrape_handler(request: BatchScrapeQuery, backend: str):
+    async for processed_response in batch_scrape_progress(request, backend):
+        pass
     return processed_response
-        
+
+
+async def native_batch_documents(request: BatchScrapeQuery, backend: str, poll_timeout: float = None):
+    """Yield (index, document) as the batch job returns them"""
+    emitted = 0
+    async for processed_response in batch_scrape_progress(request, backend, progress=True, poll_timeout=poll_timeout):
+        documents = processed_response.get('data')
+        if isinstance(documents, list):
+            for document in documents[emitted:]:
+                yield emitted, document
+                emitted += 1
+
 ##############  handler batch scrape requests
 
+
+
+##############  fan-out batch scrape over single url backends
+host_semaphores = {} # (backend, host) -> [semaphore, number of users], shared by all the batches
+host_next_start = {} # (backend, host) -> time before which the backend must not scrape the host again
+backend_semaphores = {} # backend -> semaphore
+
+
+@asynccontextmanager
+async def host_slot(host: tuple, limit: int, delay: float = 0):
+    """Limit the number of concurrent scrapes of a host by a backend, and space their starts by delay seconds.
+    host is (backend, host): the politeness settings are per backend"""
+    entry = host_semaphores.setdefault(host, [asyncio.Semaphore(limit), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if delay > 0:
+                now = time.monotonic()
+                start = max(now, host_next_start.get(host, 0))
+                host_next_start[host] = start + delay # reserved before waiting, so the next scrape waits after this one
+                await asyncio.sleep(start - now)
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del host_semaphores[host]
+            if host_next_start.get(host, 0) <= time.monotonic():
+                host_next_start.pop(host, None)
+
+
+robots_delays = OrderedDict() # host url -> (expires, task of the crawl delay), least recently used first
+
+
+async def robots_delay(url: str) -> float:
+    """Crawl-delay of the robots.txt of the host, cached for ROBOTS_TTL"""
+    parsed = httpx.URL(url)
+    root = f"{parsed.scheme}://{parsed.netloc.decode()}"
+    entry = robots_delays.get(root)
+    if entry is None or entry[0] < time.time():
+        entry = (time.time() + ROBOTS_TTL, asyncio.ensure_future(fetch_robots_delay(root)))
+        robots_delays[root] = entry
+        while len(robots_delays) > ROBOTS_CACHE_SIZE: # broad crawls see new hosts all the time
+            robots_delays.popitem(last=False)
+    robots_delays.move_to_end(root)
+    return await asyncio.shield(entry[1])
+
+
+async def fetch_robots_delay(root: str) -> float:
+    try:
+        async with get_http_client().stream("GET", f"{root}/robots.txt", timeout=5, follow_redirects=True) as response:
+            if response.status_code != 200:
+                return 0
+            body = await read_body(response, 512 * 1024)
+    except Exception as e:
+        print(f"No robots.txt for {root}: {e}")
+        return 0
+
+    return parse_crawl_delay(body.decode(errors='replace'))
+
+
+def parse_crawl_delay(robots: str) -> float:
+    """Crawl-delay of the `User-agent: *` group of a robots.txt (urllib.robotparser only reads whole seconds)"""
+    agents = []
+    in_rules = False
+    delay = 0
+    for line in robots.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if ':' not in line:
+            continue
+        field, value = [part.strip() for part in line.split(':', 1)]
+        field = field.lower()
+        if field == 'user-agent':
+            if in_rules: # a new group starts
+                agents = []
+                in_rules = False
+            agents.append(value)
+            continue
+        in_rules = True
+        if field == 'crawl-delay' and '*' in agents:
+            try:
+                delay = float(value)
+            except ValueError:
+                pass
+    return delay
+
+
+def politeness_config(backend: str) -> dict:
+    """`politeness` section of the backend, None if the scrapes of the backend are not throttled per host"""
+    config = scrape_backends.get(backend, {}).get('politeness')
+    if config is None and (POLITENESS_DELAY > 0 or RESPECT_ROBOTS.lower() in TRUE_VALUES):
+        config = {}
+    return config
+
+
+@asynccontextmanager
+async def polite_slot(backend: str, url: str, concurrency: int = None):
+    """Per host concurrency and delay of the backend, with the crawl delay of robots.txt if enabled"""
+    config = politeness_config(backend) or {}
+    concurrency = int(config.get('concurrency', concurrency or FANOUT_HOST_CONCURRENCY))
+    delay = float(config.get('delay', POLITENESS_DELAY))
+    if str(config.get('robots', RESPECT_ROBOTS)).lower() in TRUE_VALUES:
+        delay = max(delay, await robots_delay(url))
+    async with host_slot((backend, httpx.URL(url).host), concurrency, delay):
+        yield
+
+
+async def polite_scrape_handler(request: FirecrawlScapeModel, backend: str):
+    """scrape_handler, behind the per host limits of the backend if it has some"""
+    if politeness_config(backend) is None:
+        return await scrape_handler(request, backend)
+    async with polite_slot(backend, str(request.url)):
+        return await scrape_handler(request, backend)
+
+
+def interleave_hosts(urls: list) -> list:
+    """Indexes of the urls, one host after the other, so a site with many urls doesn't hold every slot"""
+    by_host = {}
+    for index, url in enumerate(urls):
+        by_host.setdefault(httpx.URL(url).host, []).append(index)
+    queues = list(by_host.values())
+    order = []
+    for position in range(max((len(queue) for queue in queues), default=0)):
+        order += [queue[position] for queue in queues if position < len(queue)]
+    return order
+
+
+async def fan_out_documents(request: BatchScrapeQuery, backend: str):
+    """Scrape the urls concurrently with a single url backend, yield (index, document) as soon as a url is done"""
+    urls = [str(http_url) for http_url in request.urls]
+    print(f"Scraping {len(urls)} urls with {backend} (fan-out)")
+
+    batch_config = scrape_backends[backend].get('batch', {})
+    concurrency = int(batch_config.get('concurrency', FANOUT_CONCURRENCY))
+    host_concurrency = int(batch_config.get('host_concurrency', FANOUT_HOST_CONCURRENCY))
+    # kept for the whole batch: a config reload gives the next batches a new semaphore
+    semaphore = backend_semaphores.setdefault(backend, asyncio.Semaphore(concurrency))
+
+    options = request.model_dump(exclude={'urls'}, exclude_unset=True)
+
+    async def scrape_one(index: int, url: str):
+        # the host slot first, so the urls waiting for a busy host don't hold the slots of the backend
+        async with polite_slot(backend, url, host_concurrency), semaphore:
+            try:
+                result = await cached_call("scrape", backend, FirecrawlScapeModel(url=url, **options), scrape_handler)
+                document = result.get('data')
+                document = dict(document) if isinstance(document, dict) else {}
+            except HTTPException as e:
+                document = {'metadata': {'error': str(e.detail), 'statusCode': e.status_code}}
+            except Exception as e:
+                document = {'metadata': {'error': f"Unexpected error: {str(e)}", 'statusCode': 500}}
+
+        metadata = document.get('metadata')
+        metadata = dict(metadata) if isinstance(metadata, dict) else {}
+        metadata.setdefault('url', url)
+        metadata['sourceURL'] = url
+        document['metadata'] = metadata
+        return index, document
+
+    tasks = [asyncio.ensure_future(scrape_one(index, urls[index])) for index in interleave_hosts(urls)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks: # the client went away
+            task.cancel()
+
+
+async def fan_out_batch_scrape(request: BatchScrapeQuery, backend: str):
+    """Batch scrape with a single url backend, the urls are scraped concurrently"""
+    documents = [None] * len(request.urls)
+    async for index, document in fan_out_documents(request, backend):
+        documents[index] = document # results stay in the order of the urls
+
+    return {
+        "success": True,
+        "backend": backend,
+        "total": len(documents),
+        "completed": sum(1 for document in documents if 'error' not in document['metadata']),
+        "data": documents,
+    }
+
+##############  fan-out batch scrape over single url backends
+
                 
-@app.post("/v1/batch/scrape")
-async def batch_scrape_post(
-    request: BatchScrapeQuery,
-    backend: Optional[str] = Query(None, description="Backend to use (optional)"), 
+######## Streaming
+
+def stream_response(records, format: str) -> StreamingResponse:
+    """Send the records as soon as they are produced, as NDJSON or Server-Sent Events"""
+    async def body():
+        async for record in records:
+            if format == "sse":
+                yield f"event: {record['type']}\ndata: {json.dumps(record)}\n\n"
+            else:
+                yield json.dumps(record) + "\n"
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type)
+
+
+async def batch_scrape_stream(request: BatchScrapeQuery, backend: str):
+    """Records of a streamed batch scrape: one per document, then a summary"""
+    startTime = time.time()
+    completed = failed = 0
+    success = True
+
+    if backend in batch_scrape_backends:
+        documents = native_batch_documents(request, backend)
+    else:
+        documents = fan_out_documents(request, backend)
+
+    try:
+        async for index, document in documents:
+            if isinstance(document, dict) and 'error' in (document.get('metadata') or {}):
+                failed += 1
+            else:
+                completed += 1
+            yield {"type": "document", "index": index, "data": document}
+    except HTTPException as e:
+        success = False
+        yield {"type": "error", "statusCode": e.status_code, "error": str(e.detail)}
+
+    yield {
+        "type": "summary",
+        "success": success,
+        "backend": backend,
+        "total": len(request.urls),
+        "completed": completed,
+        "failed": failed,
+        "processingTime": round(time.time()-startTime, 3),
+    }
+
+
+async def search_stream(request: FirecrawlSearchModel, backend: str):
+    """Records of a streamed search: one per result as soon as its page is scraped, then a summary"""
+    startTime = time.time()
+    completed = failed = 0
+    success = True
+    metadata = None
+
+    try:
+        processed_response = await search_results(request, backend)
+        metadata = processed_response.get('metadata')
+        results = processed_response['data']
+
+        if search_needs_scrape(request, backend):
+            positions = {} # url -> indexes of the results, the documents of native batches come in any order
+            for index, item in enumerate(results):
+                positions.setdefault(item['url'].rstrip('/'), []).append(index)
+            batch_scrape_request = BatchScrapeQuery(urls=[item['url'] for item in results], formats=request.scrapeOptions.formats)
+            async for record in batch_scrape_stream(batch_scrape_request, await select_batch_scrape_backend(None)):
+                if record['type'] == "error":
+                    success = False
+                    yield record
+                if record['type'] != "document":
+                    continue
+                document = record['data'] if isinstance(record['data'], dict) else {}
+                document_metadata = document.get('metadata') or {}
+                urls = [document_metadata.get(key, '').rstrip('/') for key in ('sourceURL', 'url')]
+                indexes = next((positions[url] for url in urls if url in positions), [record['index']])
+                for index in indexes:
+                    if 'error' in document_metadata: # as in the batch stream, the failed scrape comes with its error
+                        failed += 1
+                        yield {"type": "document", "index": index, "data": {**results[index], "metadata": document_metadata}}
+                    else:
+                        completed += 1
+                        combined = combined_search_scrape({'data': [results[index]]}, [document])
+                        yield {"type": "document", "index": index, "data": combined[0] if combined else results[index]}
+        else:
+            for index, item in enumerate(results):
+                completed += 1
+                yield {"type": "document", "index": index, "data": item}
+    except HTTPException as e:
+        success = False
+        yield {"type": "error", "statusCode": e.status_code, "error": str(e.detail)}
+
+    yield {
+        "type": "summary",
+        "success": success,
+        "backend": backend,
+        "metadata": metadata,
+        "completed": completed,
+        "failed": failed,
+        "processingTime": round(time.time()-startTime, 3),
+    }
+
+
+######## Batch scrape jobs
+
+class JobStore:
+    """Batch scrape jobs and their documents, in SQLite so they survive restarts.
+    The file is created by the first job, reading a store without file finds nothing"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self.db_lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return self.db is not None or os.path.exists(self.path)
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL") # the workers share the file
+            self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, backend TEXT, request TEXT, status TEXT,
+                total INTEGER, completed INTEGER, failed INTEGER, error TEXT, created REAL, expires REAL, owner TEXT, heartbeat REAL)""")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+            for column, type in (("owner", "TEXT"), ("heartbeat", "REAL")): # files created before the workers
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {type}")
+            self.db.execute("CREATE TABLE IF NOT EXISTS documents (job TEXT, position INTEGER, data TEXT, PRIMARY KEY (job, position))")
+            self.db.commit()
+        return self.db
+
+    def create(self, id: str, backend: str, request: dict, total: int):
+        with self.db_lock:
+            db = self.connect()
+            now = time.time()
+            db.execute("INSERT INTO jobs VALUES (?, ?, ?, 'scraping', ?, 0, 0, NULL, ?, ?, ?, ?)", (id, backend, json.dumps(request), total, now, now + JOB_TTL, WORKER_ID, now))
+            db.commit()
+
+    def get(self, id: str) -> dict:
+        with self.db_lock:
+            if not self.exists():
+                return None
+            cursor = self.connect().execute("SELECT * FROM jobs WHERE id = ? AND expires >= ?", (id, time.time()))
+            row = cursor.fetchone()
+            return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def unfinished(self) -> list:
+        """Jobs to take over: not owned, or owned by a worker that stopped its heartbeat"""
+        with self.db_lock:
+            if not self.exists():
+                return []
+            rows = self.connect().execute("SELECT id FROM jobs WHERE status = 'scraping' AND (owner IS NULL OR heartbeat < ?) ORDER BY created", (time.time() - JOB_LEASE,))
+            return [row[0] for row in rows]
+
+    def claim(self, id: str) -> bool:
+        """Take the job for this worker, False if another worker runs it"""
+        with self.db_lock:
+            db = self.connect()
+            now = time.time()
+            cursor = db.execute("UPDATE jobs SET owner = ?, heartbeat = ? WHERE id = ? AND status = 'scraping' AND (owner IS NULL OR owner = ? OR heartbeat < ?)",
+                                (WORKER_ID, now, id, WORKER_ID, now - JOB_LEASE))
+            db.commit()
+            return cursor.rowcount == 1
+
+    def heartbeat(self, id: str):
+        with self.db_lock:
+            db = self.connect()
+            db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ?", (time.time(), id, WORKER_ID))
+            db.commit()
+
+    def release(self, ids: list):
+        """Give back the jobs of this worker, they are resumed by the next worker that starts or scans"""
+        if not ids:
+            return
+        with self.db_lock:
+            db = self.connect()
+            db.executemany("UPDATE jobs SET owner = NULL WHERE id = ? AND owner = ? AND status = 'scraping'", [(id, WORKER_ID) for id in ids])
+            db.commit()
+
+    def add_document(self, id: str, position: int, document: dict, failed: bool):
+        with self.db_lock:
+            db = self.connect()
+            db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)", (id, position, json.dumps(document)))
+            db.execute(f"UPDATE jobs SET {'failed' if failed else 'completed'} = {'failed' if failed else 'completed'} + 1 WHERE id = ?", (id,))
+            db.commit()
+
+    def positions(self, id: str) -> set:
+        """Positions of the urls already scraped"""
+        with self.db_lock:
+            return {row[0] for row in self.connect().execute("SELECT position FROM documents WHERE job = ?", (id,))}
+
+    def documents(self, id: str, skip: int, limit: int) -> list:
+        with self.db_lock:
+            rows = self.connect().execute("SELECT data FROM documents WHERE job = ? ORDER BY position LIMIT ? OFFSET ?", (id, limit, skip))
+            return [json.loads(row[0]) for row in rows]
+
+    def finish(self, id: str, status: str, error: str = None):
+        with self.db_lock:
+            db = self.connect()
+            db.execute("UPDATE jobs SET status = ?, error = ? WHERE id = ?", (status, error, id))
+            db.commit()
+
+    def clean(self):
+        """Delete the expired jobs"""
+        with self.db_lock:
+            if not self.exists():
+                return
+            db = self.connect()
+            db.execute("DELETE FROM documents WHERE job IN (SELECT id FROM jobs WHERE expires < ?)", (time.time(),))
+            db.execute("DELETE FROM jobs WHERE expires < ?", (time.time(),))
+            db.commit()
+
+    def close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}" # owner of the jobs run by this process
+
+
+class JobQueue:
+    """Run the batch scrape jobs on a pool of workers, the unfinished jobs are resumed at startup.
+    With several processes, a job is owned by one of them and taken over when its heartbeat stops"""
+
+    def __init__(self, store: JobStore, workers: int):
+        self.store = store
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.running = set()
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        await asyncio.to_thread(self.store.clean)
+        await self.resume()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.watch()))
+
+    async def resume(self):
+        for id in await asyncio.to_thread(self.store.unfinished):
+            if id not in self.running:
+                print(f"Resuming batch scrape job {id}")
+                self.queue.put_nowait(id)
+
+    async def watch(self):
+        """Take over the jobs of the workers that died"""
+        while True:
+            await asyncio.sleep(JOB_LEASE)
+            await self.resume()
+
+    async def stop(self):
+        """Stop the workers, the running jobs are resumed at the next start or by another worker"""
+        running = list(self.running)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await asyncio.to_thread(self.store.release, running)
+        self.store.close()
+
+    async def submit(self, request: BatchScrapeQuery, backend: str) -> str:
+        if not self.tasks:
+            raise HTTPException(status_code=503, detail="The batch scrape job queue is not running")
+        id = str(uuid.uuid4())
+        await asyncio.to_thread(self.store.create, id, backend, request.model_dump(mode='json', exclude_unset=True), len(request.urls))
+        self.queue.put_nowait(id)
+        return id
+
+    async def worker(self):
+        while True:
+            id = await self.queue.get()
+            try:
+                await self.run(id)
+            except asyncio.CancelledError:
+                raise
+            except HTTPException as e:
+                await asyncio.to_thread(self.store.finish, id, "failed", str(e.detail))
+            except Exception as e:
+                print(f"Batch scrape job {id} failed: {e}")
+                await asyncio.to_thread(self.store.finish, id, "failed", f"Unexpected error: {str(e)}")
+
+    async def run(self, id: str):
+        if id in self.running or not await asyncio.to_thread(self.store.claim, id):
+            return
+        self.running.add(id)
+        heartbeat = asyncio.create_task(self.heartbeat(id))
+        try:
+            await self.scrape(id)
+        finally:
+            heartbeat.cancel()
+            self.running.discard(id)
+
+    async def heartbeat(self, id: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            await asyncio.to_thread(self.store.heartbeat, id)
+
+    async def scrape(self, id: str):
+        job = await asyncio.to_thread(self.store.get, id)
+        if job is None:
+            return
+        request = BatchScrapeQuery(**json.loads(job['request']))
+        backend = job['backend']
+
+        # skip the urls scraped before a restart
+        done = await asyncio.to_thread(self.store.positions, id)
+        positions = [position for position in range(len(request.urls)) if position not in done]
+        if positions:
+            remaining = request.model_copy(update={'urls': [request.urls[position] for position in positions]})
+            if backend in batch_scrape_backends:
+                # nobody waits on a background job: it is bound by JOB_TIMEOUT, not the request timeout,
+                # and fails when it expires instead of holding a worker forever
+                documents = native_batch_documents(remaining, backend, JOB_TIMEOUT)
+            else:
+                documents = fan_out_documents(remaining, backend)
+            async for index, document in documents:
+                failed = isinstance(document, dict) and 'error' in (document.get('metadata') or {})
+                await asyncio.to_thread(self.store.add_document, id, positions[index], document, failed)
+
+        await asyncio.to_thread(self.store.finish, id, "completed")
+
+
+job_store = JobStore(JOB_FILE)
+job_queue = JobQueue(job_store, JOB_WORKERS)
+
+
+@app.get("/v1/batch/scrape/{id}", name="batch_scrape_status")
+async def batch_scrape_status(
+    id: str,
+    request: Request,
+    skip: NonNegativeInt = Query(0, description="Documents to skip, to read the next page"),
 ):
-    
+    job = await asyncio.to_thread(job_store.get, id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch scrape job {id} not found")
+    set_request_backend(job['backend'])
+
+    documents = await asyncio.to_thread(job_store.documents, id, skip, JOB_PAGE_SIZE)
+    result = {
+        "success": job['status'] != "failed",
+        "status": job['status'],
+        "backend": job['backend'],
+        "total": job['total'],
+        "completed": job['completed'],
+        "failed": job['failed'],
+        "expiresAt": datetime.fromtimestamp(job['expires'], timezone.utc).isoformat(),
+        "data": documents,
+    }
+    if job['error']:
+        result['error'] = job['error']
+    if skip + len(documents) < job['completed'] + job['failed']:
+        result['next'] = str(request.url.include_query_params(skip=skip + len(documents)))
+    return result
+
+
+async def select_batch_scrape_backend(backend: str = None) -> str:
     if not backend:
         backend = SCRAPE_BACKEND
-    
+
     if not backend:
-        raise HTTPException(status_code=400, detail="Missing backend. Choose from 'firecrawl', 'crawl4ai' or 'tavily.")
+        backend = "jina"  # jina can be used without an API key
 
     options = backend.split(',')
-    if isinstance(options, list):
-        try:
-            options.remove("jina") # not compatible with batch scrape
-        except:
-            pass
-        try:
-            options.remove("markdowner") # not compatible with batch scrape
-        except:
-            pass
-        if not options:
-            raise HTTPException(status_code=400, detail="Missing backend. Choose from 'firecrawl', 'crawl4ai' or 'tavily.")
-        if SCRAPE_BACKEND_ROTATE == "random":
-            # Split the string by comma to get a list of options
-            # Randomly select one of the options
-            backend = random.choice(options)
-        #elif SCRAPE_BACKEND_ROTATE == "sequential":
-        else:
-            global last_scrape_backend 
-            if last_scrape_backend != None:
-                last_scrape_backend = (last_scrape_backend + 1) % len(options)
-                backend = options[last_scrape_backend]
+    backend = await select_backend("batch_scrape", options, SCRAPE_BACKEND_ROTATE)
 
-            else:
-                last_scrape_backend = 0
-                backend = options[last_scrape_backend]
+    if backend not in batch_scrape_backends and backend not in scrape_backends:
+        raise HTTPException(status_code=400, detail=f"Invalid backend '{backend}'. Choose from {', '.join(sorted(set(scrape_backends) | set(batch_scrape_backends)))}.")
+    return backend
 
-    if backend not in ["firecrawl", "crawl4ai", "tavily"]:
-        raise HTTPException(status_code=400, detail=f"Invalid backend '{backend}'. Choose from 'firecrawl', 'crawl4ai' or 'tavily.")
+                
+@app.post("/v1/batch/scrape")
+async def batch_scrape_post(
+    request: BatchScrapeQuery,
+    backend: Optional[str] = Query(None, description="Backend to use (optional)"), 
+    stream: Optional[Literal["ndjson", "sse"]] = Query(None, description="Stream each document as soon as it is scraped (optional)"),
+    async_job: Optional[bool] = Query(None, alias="async", description="Return a job id at once, the results are read from /v1/batch/scrape/{id} (optional)"),
+    http_request: Request = None,
+):
+    if async_job is None:
+        async_job = BATCH_SCRAPE_ASYNC.lower() in TRUE_VALUES
 
-    result = await batch_scrape_handler(request, backend)
-    return result
+    backend = await select_batch_scrape_backend(backend)
+    set_request_backend(backend)
+
+    if stream:
+        return stream_response(batch_scrape_stream(request, backend), stream)
+
+    if async_job:
+        id = await job_queue.submit(request, backend)
+        url = str(http_request.url_for("batch_scrape_status", id=id)) if http_request else f"/v1/batch/scrape/{id}"
+        return {"success": True, "id": id, "url": url}
+
+    if backend in batch_scrape_backends: # native batch API
+        return await batch_scrape_handler(request, backend)
 
+    return await fan_out_batch_scrape(request, backend) # one call per url
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    if WORKERS > 1 and not state_store.shared:
+        print("Warning: with several workers and STATE_STORE=memory, rotation, cache and rate limits are per worker")
+    uvicorn.run("app:app", host="0.0.0.0", port=PORT, workers=WORKERS, reload=RELOAD.lower() in TRUE_VALUES)
\ No newline at end of file
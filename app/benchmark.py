@@ -0,0 +1,295 @@
+"""Benchmark of the scrape and search backends of CrawlRouter
+
+Calls scrape_handler / search_handler of every configured backend (or the ones given with --backends)
+over a list of urls or queries, and prints the success rate, latency percentiles, throughput and payload
+size per backend and per site, as the tables of BENCHMARK.md.
+
+    python benchmark.py scrape --backends jina,firecrawl --concurrency 5
+    python benchmark.py search --queries queries.txt --csv results/search
+    python benchmark.py scrape --record recordings.json   # save the answers of the backends
+    python benchmark.py scrape --replay recordings.json   # replay them offline, to measure the overhead of CrawlRouter
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import asyncio
+import argparse
+import csv
+
+import httpx
+
+# app.py loads its config files from the app directory, the paths given in arguments are relative to the caller
+CALLER_DIR = os.getcwd()
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+import app
+
+
+# the 20 urls of BENCHMARK.md
+DEFAULT_URLS = [
+    "https://perdu.com",
+    "https://www.bloomberg.com",
+    "https://www.20minutes.fr/",
+    "https://finance.yahoo.com/",
+    "https://www.firecrawl.dev/",
+    "https://www.nytimes.com/",
+    "https://www.google.com/",
+    "https://www.booking.com/",
+    "https://www.twitch.tv/",
+    "https://www.fandom.com/explore",
+    "https://www.quora.com/",
+    "https://www.amazon.com/",
+    "https://www.spotify.com/",
+    "https://www.wikimedia.org/",
+    "https://www.reddit.com/",
+    "https://weather.com",
+    "https://edition.cnn.com/",
+    "https://www.imdb.com/",
+    "https://linkedin.com",
+    "https://www.wikipedia.org/",
+]
+
+DEFAULT_QUERIES = [
+    "firecrawl",
+    "web scraping api",
+    "python httpx http2",
+    "weather paris",
+    "best markdown converter",
+]
+
+
+######## Record and replay of the backend answers
+
+# query parameters carrying credentials (google key, serpapi and scrapingbee api_key, ...)
+SECRET_PARAMS = re.compile(r"key|token|secret|password|auth|signature", re.IGNORECASE)
+
+
+def redact_url(url: httpx.URL) -> str:
+    """The url without its credentials, to be stored in the recordings"""
+    params = [(name, "REDACTED" if SECRET_PARAMS.search(name) else value) for name, value in url.params.multi_items()]
+    return str(url.copy_with(userinfo=b"", params=params))
+
+
+def request_key(request: httpx.Request) -> str:
+    """Method, redacted url and body hash of an upstream request, without the headers (API keys)"""
+    key = f"{request.method} {redact_url(request.url)}"
+    if request.content:
+        key += " " + hashlib.sha256(request.content).hexdigest()
+    return key
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Send the requests to the backends and keep their answers"""
+
+    def __init__(self, recordings: dict):
+        self.recordings = recordings
+        self.transport = httpx.AsyncHTTPTransport(http2=app.HTTP2_AVAILABLE)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        response = httpx.Response(response.status_code, headers=response.headers, content=await response.aread(), request=request)
+        self.recordings[request_key(request)] = {
+            'status': response.status_code,
+            'content_type': response.headers.get('content-type', ''),
+            'body': base64.b64encode(response.content).decode(),
+            'elapsed': time.perf_counter() - start,
+        }
+        return httpx.Response(response.status_code, headers={'content-type': response.headers.get('content-type', '')}, content=response.content, request=request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Answer with the recorded responses, 404 for the requests that were not recorded"""
+
+    def __init__(self, recordings: dict, latency: bool = False):
+        self.recordings = recordings
+        self.latency = latency
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        recording = self.recordings.get(request_key(request))
+        if recording is None:
+            return httpx.Response(404, json={'success': False, 'error': 'not recorded'}, request=request)
+        if self.latency:
+            await asyncio.sleep(recording['elapsed'])
+        return httpx.Response(recording['status'], headers={'content-type': recording['content_type']}, content=base64.b64decode(recording['body']), request=request)
+
+
+def use_transport(transport: httpx.AsyncBaseTransport):
+    """Make the pooled clients of the app go through the transport"""
+    app.http_clients.clear()
+    app.build_http_client = lambda client_config=None: httpx.AsyncClient(transport=transport, timeout=app.HTTP_TIMEOUT)
+
+
+######## Benchmark
+
+async def call_backend(type: str, backend: str, item: str, timeout: float) -> dict:
+    """One scrape or search, returns its outcome, latency and payload size"""
+    start = time.perf_counter()
+    try:
+        if type == "scrape":
+            call = app.scrape_handler(app.FirecrawlScapeModel(url=item), backend)
+        else:
+            call = app.search_handler(app.FirecrawlSearchModel(query=item), backend)
+        result = await asyncio.wait_for(call, timeout)
+        ok = app.is_success(result) and bool(result.get('data'))
+        size = len(json.dumps(result))
+        error = '' if ok else 'empty answer'
+    except asyncio.TimeoutError:
+        ok, size, error = False, 0, 'timeout'
+    except app.HTTPException as e:
+        ok, size, error = False, 0, f"{e.status_code}"
+    except Exception as e:
+        ok, size, error = False, 0, str(e)
+    return {'backend': backend, 'item': item, 'ok': ok, 'latency': time.perf_counter() - start, 'size': size, 'error': error}
+
+
+async def run_backend(type: str, backend: str, items: list, concurrency: int, timeout: float) -> tuple:
+    """Run all the items on one backend, returns the results and the wall time"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(item):
+        async with semaphore:
+            return await call_backend(type, backend, item, timeout)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited(item) for item in items))
+    return results, time.perf_counter() - start
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def summarize(results: list, wall_time: float = None) -> dict:
+    latencies = [result['latency'] for result in results if result['ok']]
+    ok = len(latencies)
+    summary = {
+        '# OK': ok,
+        '%': f"{round(100 * ok / len(results))}%" if results else "0%",
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+    }
+    if wall_time is not None:
+        summary['req/s'] = round(len(results) / wall_time, 2) if wall_time else 0
+        summary['avg size'] = round(sum(result['size'] for result in results if result['ok']) / ok) if ok else 0
+    return summary
+
+
+def markdown_table(first_column: str, rows: dict) -> str:
+    headers = [first_column] + list(next(iter(rows.values())).keys())
+    lines = ["| " + " | ".join(headers) + " |", "|" + "|".join(["---"] + [":---:"] * (len(headers) - 1)) + "|"]
+    for name, row in rows.items():
+        lines.append("| " + " | ".join([name] + [str(value) for value in row.values()]) + " |")
+    return "\n".join(lines)
+
+
+def write_csv(path: str, first_column: str, rows: dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([first_column] + list(next(iter(rows.values())).keys()))
+        for name, row in rows.items():
+            writer.writerow([name] + list(row.values()))
+
+
+async def benchmark(args):
+    for name in ['urls', 'queries', 'markdown', 'csv', 'record', 'replay']:
+        if getattr(args, name):
+            setattr(args, name, os.path.join(CALLER_DIR, getattr(args, name)))
+
+    backends_config = app.scrape_backends if args.type == "scrape" else app.search_backends
+    backends = args.backends.split(',') if args.backends else list(backends_config.keys())
+    unknown = [backend for backend in backends if backend not in backends_config]
+    if unknown:
+        sys.exit(f"Unknown {args.type} backends: {', '.join(unknown)}")
+
+    if args.type == "scrape":
+        items = load_lines(args.urls) if args.urls else DEFAULT_URLS
+    else:
+        items = load_lines(args.queries) if args.queries else DEFAULT_QUERIES
+    items = items * args.repeat
+
+    recordings = {}
+    if args.replay:
+        with open(args.replay) as f:
+            recordings = json.load(f)
+        use_transport(ReplayTransport(recordings, args.replay_latency))
+    elif args.record:
+        use_transport(RecordingTransport(recordings))
+
+    all_results = []
+    per_backend = {}
+    try:
+        for backend in backends:
+            results, wall_time = await run_backend(args.type, backend, items, args.concurrency, args.timeout)
+            all_results += results
+            per_backend[backend] = summarize(results, wall_time)
+    finally:
+        for client in app.http_clients.values():
+            await client.aclose()
+        app.http_clients.clear()
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            json.dump(recordings, f)
+        print(f"{len(recordings)} answers recorded in {args.record}")
+
+    per_item = {item: summarize([result for result in all_results if result['item'] == item]) for item in dict.fromkeys(items)}
+    item_column = "Address" if args.type == "scrape" else "Query"
+
+    print()
+    print(f"## {args.type.capitalize()} backends\n")
+    print(markdown_table("Provider", per_backend))
+    print(f"\n*{len(items)} {'urls' if args.type == 'scrape' else 'queries'} per backend, concurrency {args.concurrency}, latencies in seconds, sizes in bytes*\n")
+    print(f"## Per {'website' if args.type == 'scrape' else 'query'}\n")
+    print(markdown_table(item_column, per_item))
+
+    if args.markdown:
+        with open(args.markdown, 'w') as f:
+            f.write(f"## {args.type.capitalize()} backends\n\n{markdown_table('Provider', per_backend)}\n\n")
+            f.write(f"## Per {'website' if args.type == 'scrape' else 'query'}\n\n{markdown_table(item_column, per_item)}\n")
+    if args.csv:
+        write_csv(f"{args.csv}-backends.csv", "Provider", per_backend)
+        write_csv(f"{args.csv}-{'sites' if args.type == 'scrape' else 'queries'}.csv", item_column, per_item)
+
+    errors = [result for result in all_results if not result['ok']]
+    if errors and args.verbose:
+        print("\n## Errors\n")
+        for result in errors:
+            print(f"* {result['backend']} {result['item']}: {result['error']}")
+
+
+def load_lines(path: str) -> list:
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the CrawlRouter backends")
+    parser.add_argument("type", choices=["scrape", "search"])
+    parser.add_argument("--backends", help="comma-separated backends, all the configured ones by default")
+    parser.add_argument("--urls", help="file with one url per line, the urls of BENCHMARK.md by default")
+    parser.add_argument("--queries", help="file with one query per line")
+    parser.add_argument("--concurrency", type=int, default=5, help="concurrent requests per backend")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times each url or query is sent")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before a request is counted as failed")
+    parser.add_argument("--markdown", help="write the tables to this markdown file")
+    parser.add_argument("--csv", help="write the tables to PREFIX-backends.csv and PREFIX-sites.csv")
+    parser.add_argument("--record", help="save the answers of the backends to this file")
+    parser.add_argument("--replay", help="answer with the responses recorded in this file instead of calling the backends")
+    parser.add_argument("--replay-latency", action="store_true", help="wait the recorded latency before each replayed answer")
+    parser.add_argument("--verbose", action="store_true", help="list the errors")
+    asyncio.run(benchmark(parser.parse_args()))
@@ -0,0 +1,190 @@
+"""Load test of one CrawlRouter worker against the mock backends
+
+Starts mock_backends.py and CrawlRouter (or uses a running CrawlRouter with --router), sends requests
+with a fixed concurrency and prints the throughput, the latency seen by the client and, from /metrics,
+how the time is split in CrawlRouter between the backend, the templates and the rest (router overhead).
+
+    python loadtest.py --endpoint scrape --backend jina --requests 2000 --concurrency 50
+    python loadtest.py --endpoint search --backend searxng --latency 0.05
+    python loadtest.py --endpoint batch --backend firecrawl --requests 100 --batch-size 10
+"""
+import os
+import re
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+from collections import Counter
+
+import httpx
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def mock_environment(mock_url: str) -> dict:
+    """Endpoints and fake keys pointing every mocked backend to the mock server"""
+    return {
+        "JINA_ENDPOINT": f"{mock_url}/jina",
+        "FIRECRAWL_SCRAPE_ENDPOINT": f"{mock_url}/firecrawl/v1/scrape",
+        "FIRECRAWL_BATCH_SCRAPE_ENDPOINT": f"{mock_url}/firecrawl/v1/batch/scrape",
+        "FIRECRAWL_SEARCH_ENDPOINT": f"{mock_url}/firecrawl/v1/search",
+        "TAVILY_ENDPOINT": f"{mock_url}/tavily",
+        "SEARXNG_ENDPOINT": f"{mock_url}/searxng",
+        "GOOGLE_CSE_ENDPOINT": f"{mock_url}/google",
+        "FIRECRAWL_API_KEY": "mock",
+        "TAVILY_API_KEY": "mock",
+        "GOOGLE_CSE_ID": "mock",
+        "GOOGLE_CSE_KEY": "mock",
+        "CACHE_TTL": "0", # every request must reach the backend
+    }
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.RequestError:
+                await asyncio.sleep(0.2)
+    sys.exit(f"{url} did not start")
+
+
+def request_for(endpoint: str, backend: str, index: int, batch_size: int) -> tuple:
+    """Path, query parameters and body of the index-th request, urls are unique so nothing is served by a cache"""
+    if endpoint == "scrape":
+        return "/v1/scrape", {"backend": backend}, {"url": f"https://example.com/page{index}"}
+    if endpoint == "search":
+        return "/v1/search", {"backend": backend}, {"query": f"query {index}"}
+    return "/v1/batch/scrape", {"backend": backend}, {"urls": [f"https://example.com/page{index}-{i}" for i in range(batch_size)]}
+
+
+def parse_metrics(text: str) -> dict:
+    """(metric, labels) -> [sum, count] of the histograms of /metrics"""
+    histograms = {}
+    for line in text.splitlines():
+        match = re.match(r'^(crawlrouter_\w+)_(sum|count)\{(.*)\} (\S+)$', line)
+        if match:
+            name, kind, labels, value = match.groups()
+            histograms.setdefault((name, labels), [0, 0])[0 if kind == "sum" else 1] = float(value)
+    return histograms
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+async def run_load(router_url: str, args) -> tuple:
+    """Send the requests with a fixed number of concurrent clients, returns the latencies, statuses and wall time"""
+    latencies = []
+    statuses = Counter()
+    indexes = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=router_url, limits=limits, timeout=args.timeout) as client:
+        async def worker():
+            for index in indexes:
+                path, params, body = request_for(args.endpoint, args.backend, index, args.batch_size)
+                start = time.perf_counter()
+                try:
+                    response = await client.post(path, params=params, json=body)
+                    statuses[response.status_code] += 1
+                except httpx.RequestError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        return latencies, statuses, time.perf_counter() - start
+
+
+def breakdown(before: dict, after: dict) -> list:
+    """Mean total, upstream and render time per request of each (type, backend) during the load test"""
+    def mean_delta(name, labels):
+        sum_after, count_after = after.get((name, labels), [0, 0])
+        sum_before, count_before = before.get((name, labels), [0, 0])
+        count = count_after - count_before
+        return ((sum_after - sum_before) / count if count else 0), count
+
+    rows = []
+    for name, labels in after:
+        if name != "crawlrouter_request_seconds":
+            continue
+        total, count = mean_delta(name, labels)
+        if not count:
+            continue
+        upstream, upstream_count = mean_delta("crawlrouter_upstream_seconds", labels)
+        render, render_count = mean_delta("crawlrouter_render_seconds", labels)
+        # upstream and render are per call, a request can make several calls (polls, fan-out)
+        upstream = upstream * upstream_count / count
+        render = render * render_count / count
+        rows.append((labels, count, total, upstream, render, total - upstream - render))
+    return rows
+
+
+async def main(args):
+    processes = []
+    try:
+        router_url = args.router
+        if not router_url:
+            mock_url = f"http://127.0.0.1:{args.mock_port}"
+            processes.append(subprocess.Popen([
+                sys.executable, os.path.join(APP_DIR, "mock_backends.py"), "--port", str(args.mock_port),
+                "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate),
+            ]))
+            router_url = f"http://127.0.0.1:{args.router_port}"
+            processes.append(subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.router_port), "--log-level", "warning"],
+                cwd=APP_DIR, env={**os.environ, **mock_environment(mock_url)}, stdout=subprocess.DEVNULL,
+            ))
+            await wait_ready(f"{mock_url}/docs")
+        await wait_ready(f"{router_url}/metrics")
+
+        async with httpx.AsyncClient() as client:
+            if args.warmup:
+                warmup = argparse.Namespace(**{**vars(args), "requests": args.warmup})
+                await run_load(router_url, warmup)
+            before = parse_metrics((await client.get(f"{router_url}/metrics")).text)
+            latencies, statuses, wall_time = await run_load(router_url, args)
+            after = parse_metrics((await client.get(f"{router_url}/metrics")).text)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    print(f"\n{args.requests} {args.endpoint} requests to {args.backend}, concurrency {args.concurrency}, backend latency {args.latency}s\n")
+    print(f"Throughput: {args.requests / wall_time:.1f} req/s")
+    print(f"Statuses:   {', '.join(f'{status}: {count}' for status, count in statuses.items())}")
+    print(f"Latency:    p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {percentile(latencies, 95) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+
+    print("\nTime spent in CrawlRouter per request (mean, from /metrics):\n")
+    print("| Labels | Requests | Total ms | Backend ms | Templates ms | Router overhead ms |")
+    print("|---|:---:|:---:|:---:|:---:|:---:|")
+    for labels, count, total, upstream, render, overhead in breakdown(before, after):
+        print(f"| {labels} | {count:.0f} | {total * 1000:.2f} | {upstream * 1000:.2f} | {render * 1000:.2f} | {overhead * 1000:.2f} |")
+    if args.endpoint == "batch":
+        print("\n*for batch scrapes, the router overhead includes the waits between two polls of the job*")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of CrawlRouter against the mock backends")
+    parser.add_argument("--endpoint", choices=["scrape", "search", "batch"], default="scrape")
+    parser.add_argument("--backend", default="firecrawl", help="backend of CrawlRouter to call, must be mocked (jina, firecrawl, tavily, searxng, google)")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=50, help="requests sent before the measure")
+    parser.add_argument("--batch-size", type=int, default=5, help="urls per batch scrape")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--latency", type=float, default=0, help="seconds the mock backends wait before answering")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--router-port", type=int, default=8100)
+    parser.add_argument("--router", help="url of a running CrawlRouter, its backends must point to the mock server (see mock_environment)")
+    asyncio.run(main(parser.parse_args()))
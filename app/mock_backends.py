@@ -0,0 +1,151 @@
+"""Mock of the backends, to load-test CrawlRouter without calling the real APIs
+
+Answers with the response shapes read by the yml configs, after a configurable latency, and fails a
+configurable share of the requests. Point the endpoints of CrawlRouter to it:
+
+    JINA_ENDPOINT=http://localhost:9100/jina
+    FIRECRAWL_SCRAPE_ENDPOINT=http://localhost:9100/firecrawl/v1/scrape
+    FIRECRAWL_BATCH_SCRAPE_ENDPOINT=http://localhost:9100/firecrawl/v1/batch/scrape
+    FIRECRAWL_SEARCH_ENDPOINT=http://localhost:9100/firecrawl/v1/search
+    TAVILY_ENDPOINT=http://localhost:9100/tavily
+    SEARXNG_ENDPOINT=http://localhost:9100/searxng
+    GOOGLE_CSE_ENDPOINT=http://localhost:9100/google
+
+    python mock_backends.py --port 9100 --latency 0.05 --error-rate 0.01
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import os
+import random
+import asyncio
+import argparse
+import itertools
+
+MOCK_LATENCY = (float)(os.getenv("MOCK_LATENCY", 0)) # seconds before each answer
+MOCK_JITTER = (float)(os.getenv("MOCK_JITTER", 0)) # random seconds added to the latency
+MOCK_ERROR_RATE = (float)(os.getenv("MOCK_ERROR_RATE", 0)) # share of the requests answered with MOCK_ERROR_STATUS
+MOCK_ERROR_STATUS = (int)(os.getenv("MOCK_ERROR_STATUS", 503))
+MOCK_BATCH_POLLS = (int)(os.getenv("MOCK_BATCH_POLLS", 1)) # polls answered "scraping" before a batch job is completed
+MOCK_PAGE_SIZE = (int)(os.getenv("MOCK_PAGE_SIZE", 2000)) # characters of markdown per page
+
+app = FastAPI(title="CrawlRouter mock backends")
+
+batch_jobs = {} # id -> [urls, polls left]
+job_ids = itertools.count(1)
+
+
+async def delay_or_fail():
+    """Wait the configured latency, return an error response for the configured share of the requests"""
+    latency = MOCK_LATENCY + random.uniform(0, MOCK_JITTER)
+    if latency > 0:
+        await asyncio.sleep(latency)
+    if MOCK_ERROR_RATE and random.random() < MOCK_ERROR_RATE:
+        return JSONResponse({"success": False, "error": "mock error"}, status_code=MOCK_ERROR_STATUS)
+    return None
+
+
+def page(url: str) -> dict:
+    content = f"# Mock page\n\nContent of {url}\n\n"
+    return {"title": f"Mock page {url}", "url": url, "content": content + "lorem ipsum " * (MOCK_PAGE_SIZE // 12)}
+
+
+def search_results(query: str, limit: int = 5) -> list:
+    return [{"title": f"Result {i} for {query}", "url": f"https://example.com/{i}?q={query}", "content": f"Snippet {i} of {query}"} for i in range(limit)]
+
+
+######## Jina
+@app.get("/jina/{url:path}")
+async def jina(url: str):
+    return await delay_or_fail() or {"code": 200, "status": 20000, "data": page(url)}
+
+
+######## Firecrawl
+@app.post("/firecrawl/v1/scrape")
+async def firecrawl_scrape(request: Request):
+    body = await request.json()
+    result = page(body.get("url"))
+    return await delay_or_fail() or {"success": True, "data": {"markdown": result["content"], "metadata": {"title": result["title"], "sourceURL": result["url"], "statusCode": 200}}}
+
+
+@app.post("/firecrawl/v1/batch/scrape")
+async def firecrawl_batch_scrape(request: Request):
+    body = await request.json()
+    error = await delay_or_fail()
+    if error:
+        return error
+    id = str(next(job_ids))
+    batch_jobs[id] = [body.get("urls", []), MOCK_BATCH_POLLS]
+    return {"success": True, "id": id, "url": f"{str(request.url).rstrip('/')}/{id}"}
+
+
+@app.get("/firecrawl/v1/batch/scrape/{id}")
+async def firecrawl_batch_status(id: str):
+    if id not in batch_jobs:
+        return JSONResponse({"success": False, "error": "job not found"}, status_code=404)
+    error = await delay_or_fail()
+    if error:
+        return error
+    urls, polls = batch_jobs[id]
+    if polls > 0:
+        batch_jobs[id][1] -= 1
+        return {"success": True, "status": "scraping", "total": len(urls), "completed": 0, "data": []}
+    del batch_jobs[id]
+    data = [{"markdown": page(url)["content"], "metadata": {"sourceURL": url, "statusCode": 200}} for url in urls]
+    return {"success": True, "status": "completed", "total": len(urls), "completed": len(urls), "data": data}
+
+
+@app.post("/firecrawl/v1/search")
+async def firecrawl_search(request: Request):
+    body = await request.json()
+    results = search_results(body.get("query"), int(body.get("limit") or 5))
+    return await delay_or_fail() or {"success": True, "data": [{"title": item["title"], "description": item["content"], "url": item["url"]} for item in results]}
+
+
+######## Tavily
+@app.post("/tavily/extract")
+async def tavily_extract(request: Request):
+    body = await request.json()
+    urls = body.get("urls")
+    urls = [urls] if isinstance(urls, str) else urls or []
+    return await delay_or_fail() or {"results": [{"url": url, "raw_content": page(url)["content"]} for url in urls], "failed_results": [], "response_time": MOCK_LATENCY}
+
+
+@app.post("/tavily/search")
+async def tavily_search(request: Request):
+    body = await request.json()
+    results = search_results(body.get("query"), int(body.get("max_results") or 5))
+    return await delay_or_fail() or {"query": body.get("query"), "results": [{**item, "raw_content": None} for item in results], "response_time": MOCK_LATENCY}
+
+
+######## SearXNG
+@app.get("/searxng/search")
+async def searxng_search(q: str, request: Request):
+    return await delay_or_fail() or {"query": q, "number_of_results": 1000, "results": search_results(q)}
+
+
+######## Google CSE
+@app.get("/google/customsearch/v1")
+async def google_search(q: str, num: int = 5):
+    results = search_results(q, num)
+    return await delay_or_fail() or {
+        "queries": {"request": [{"searchTerms": q}]},
+        "searchInformation": {"searchTime": MOCK_LATENCY, "totalResults": "1000"},
+        "items": [{"title": item["title"], "snippet": item["content"], "link": item["url"]} for item in results],
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Mock of the CrawlRouter backends")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=MOCK_LATENCY, help="seconds before each answer")
+    parser.add_argument("--jitter", type=float, default=MOCK_JITTER, help="random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE, help="share of the requests that fail, 0 to 1")
+    parser.add_argument("--error-status", type=int, default=MOCK_ERROR_STATUS)
+    parser.add_argument("--batch-polls", type=int, default=MOCK_BATCH_POLLS, help="polls before a batch job is completed")
+    args = parser.parse_args()
+
+    MOCK_LATENCY, MOCK_JITTER, MOCK_ERROR_RATE = args.latency, args.jitter, args.error_rate
+    MOCK_ERROR_STATUS, MOCK_BATCH_POLLS = args.error_status, args.batch_polls
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")